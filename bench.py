@@ -0,0 +1,306 @@
+import datetime, gc, json, os, pickle, platform, random, shutil, sqlite3, subprocess, sys, tempfile, threading, time, tracemalloc
+from schema_evolve import _apply, _diff, _get_tables, _get_views, _open, _parse_create_table, diff, fleet_evolve
+
+BENCH_RESULTS = os.environ.get('BENCH_RESULTS', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_results.jsonl'))
+REGRESSION_RATIO = 1.25 # flag phases this much slower than the last run of the same config
+
+
+def _timeit(f, repeat=3):
+  best = None
+  for _ in range(repeat):
+    start = time.perf_counter()
+    f()
+    elapsed = time.perf_counter() - start
+    best = elapsed if best is None else min(best, elapsed)
+  return best
+
+def _make_db(n_tables, n_columns=8):
+  db = sqlite3.connect(':memory:')
+  for i in range(n_tables):
+    cols = ',\n'.join([f'  c{j} text' + (' unique' if j==1 else '') for j in range(n_columns)])
+    fk = f',\n  parent_id int references t{i-1}(id)' if i else ''
+    db.execute(f'create table t{i} (\n  id int primary key,\n{cols}{fk}\n)')
+  return db
+
+def bench_introspect():
+  print('tables\tseconds')
+  for n in (10, 100, 1000, 3000):
+    db = _make_db(n)
+    print(f'{n}\t{_timeit(lambda: _get_tables(db)):.4f}')
+
+def bench_parse_commented():
+  print('columns\tseconds')
+  for n in (100, 1000, 5000, 20000):
+    cols = ',\n'.join([f'  c{j} text -- AKA[old_c{j}] some notes about c{j}' for j in range(n)])
+    sql = f'create table tbl ( -- AKA[old_tbl]\n{cols}\n)'
+    print(f'{n}\t{_timeit(lambda: _parse_create_table(sql)):.4f}')
+
+def bench_cold_start():
+  print('command\tseconds')
+  for cmd in ('pass', 'import schema_evolve', "import schema_evolve; schema_evolve.diff('create table a (b text)', 'create table a (b int)')"):
+    print(f'{cmd}\t{_timeit(lambda: subprocess.run([sys.executable, "-c", cmd], check=True), repeat=5):.4f}')
+
+def _write_sql_file(fn, n_tables, n_rows):
+  with open(fn, 'w') as f:
+    for i in range(n_tables):
+      f.write(f'CREATE TABLE t{i} (\n  id integer primary key, -- AKA[old_id]\n  name text default \'a;b\'\n);\n')
+      for j in range(n_rows):
+        f.write(f"INSERT INTO t{i} VALUES({j},'row {j}; of t{i}');\n")
+
+def bench_load_sql():
+  print('MB\tseconds\tpeak MB')
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for n_tables in (10, 100, 500):
+      fn = os.path.join(tmp_dir, f'{n_tables}.sql')
+      _write_sql_file(fn, n_tables, 1000)
+      seconds = _timeit(lambda: _open(fn), repeat=1)
+      tracemalloc.start()
+      _open(fn)
+      peak = tracemalloc.get_traced_memory()[1]
+      tracemalloc.stop()
+      print(f'{os.path.getsize(fn)/1e6:.1f}\t{seconds:.3f}\t{peak/1e6:.2f}')
+
+def bench_load_dump_ddl_only():
+  print('MB\tfull seconds\tddl_only seconds')
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for n_tables in (10, 100, 500):
+      fn = os.path.join(tmp_dir, f'{n_tables}.sql')
+      _write_sql_file(fn, n_tables, 1000)
+      full = _timeit(lambda: _open(fn), repeat=1)
+      ddl_only = _timeit(lambda: _open(fn, ddl_only=True), repeat=1)
+      print(f'{os.path.getsize(fn)/1e6:.1f}\t{full:.3f}\t{ddl_only:.3f}')
+
+def bench_fleet():
+  print('shards\tworkers\tseconds')
+  with tempfile.TemporaryDirectory() as tmp_dir:
+    for i in range(64):
+      db = sqlite3.connect(os.path.join(tmp_dir, f'shard{i}.db'))
+      db.execute('create table tbl (id integer primary key, a text)')
+      db.executemany('insert into tbl (a) values (?)', [(str(j),) for j in range(20000)])
+      db.commit()
+      db.close()
+    target = 'create table tbl (id integer primary key, a int, b text)'
+    for no_group in (True, False):
+      seconds = _timeit(lambda: fleet_evolve(target, os.path.join(tmp_dir, '*.db'), workers=1, quiet=True, no_cache=True, no_group=no_group, dry_run=False), repeat=1)
+      print(f'64\tplan only, {"per database" if no_group else "per schema"}\t{seconds:.3f}')
+    for workers in (1, 2, 4, os.cpu_count()):
+      seconds = _timeit(lambda: fleet_evolve(target, os.path.join(tmp_dir, '*.db'), workers=workers, quiet=True, no_cache=True), repeat=1)
+      print(f'64\t{workers}\t{seconds:.3f}')
+
+def bench_online_writer_stall():
+  print('rows\tmode\tmigration seconds\tworst writer stall seconds')
+  for n_rows in (100000, 1000000):
+    for online, lock_budget in ((False, None), (True, None), (True, 10)):
+      with tempfile.TemporaryDirectory() as tmp_dir:
+        fn = os.path.join(tmp_dir, 'existing.db')
+        db = sqlite3.connect(fn)
+        db.execute('PRAGMA journal_mode=wal')
+        db.execute('create table tbl (id integer primary key, a text, b text)')
+        db.executemany('insert into tbl (a, b) values (?, ?)', [(str(i), 'x'*20) for i in range(n_rows)])
+        db.commit()
+        changes = diff(fn, 'create table tbl (id integer primary key, a int, b text)', cache=False, online=online)
+        stalls, done = [], threading.Event()
+        def writer():
+          other = sqlite3.connect(fn, timeout=600)
+          while not done.is_set():
+            start = time.perf_counter()
+            other.execute("insert into tbl (a, b) values ('1', 'y')")
+            other.commit()
+            stalls.append(time.perf_counter() - start)
+            time.sleep(0.001)
+          other.close()
+        thread = threading.Thread(target=writer)
+        thread.start()
+        seconds = _timeit(lambda: _apply(db, changes, batch_size=1000 if online else 0, lock_budget=lock_budget), repeat=1)
+        done.set()
+        thread.join()
+        db.close()
+        mode = ('online' if online else 'offline') + (f', {lock_budget}ms lock budget' if lock_budget else '')
+        print(f'{n_rows}\t{mode}\t{seconds:.3f}\t{max(stalls):.4f}')
+
+def synthetic_schema(n_tables=100, n_columns=10, comment_density=.5, aka_density=.1, fk_fanout=1, n_views=10, target=False, seed=0):
+  '''
+  SQL for a synthetic schema: n_tables tables of an id plus n_columns columns, each table referencing
+  up to fk_fanout earlier tables, and n_views views joining two tables.  A comment_density share of
+  the columns get a trailing comment and an aka_density share an AKA.  With target=True, the schema
+  is the evolved version of the same seed's: per table the first column is retyped, one column is
+  added and the last one dropped, and the AKA'd columns are renamed.
+  '''
+  stmts = []
+  for i in range(n_tables):
+    parts = [('id integer primary key', '')]
+    for j in range(n_columns):
+      # one stream per column, so the source and target schemas roll the same dice
+      rng = random.Random(f'{seed}:{i}:{j}')
+      name, type_ = f'c{j}', ('text', 'int', 'real', 'blob')[j % 4]
+      has_aka, has_comment = rng.random() < aka_density, rng.random() < comment_density
+      comments = []
+      if target:
+        if j == n_columns-1 and j: continue
+        if j == 0: type_ = 'int' if type_ == 'text' else 'text'
+        if has_aka: name, comments = f'c{j}_renamed', [f'AKA[c{j}]']
+      elif has_aka:
+        comments.append(f'AKA[old_c{j}]')
+      if has_comment:
+        comments.append(f'notes about {name}; see the "{name}" docs')
+      parts.append((f'{name} {type_}', ' '.join(comments)))
+    rng = random.Random(f'{seed}:{i}:fks')
+    for k, parent in enumerate(sorted(rng.sample(range(i), min(fk_fanout, i)))):
+      parts.append((f'p{k} int references t{parent}(id)', ''))
+    if target:
+      parts.append(("added text default 'x'", ''))
+    lines = [f'  {col_def}{"," if n < len(parts)-1 else ""}{" -- "+comment if comment else ""}' for n, (col_def, comment) in enumerate(parts)]
+    stmts.append(f'create table t{i} (\n' + '\n'.join(lines) + '\n);')
+  rng = random.Random(f'{seed}:views')
+  for k in range(n_views if n_tables else 0):
+    a, b = rng.randrange(n_tables), rng.randrange(n_tables)
+    stmts.append(f'create view v{k} as select a.id, b.id as other_id from t{a} a join t{b} b on b.id = a.id;')
+  return '\n'.join(stmts) + '\n'
+
+def _fill_synthetic_db(db, n_rows, seed=0):
+  rng = random.Random(f'{seed}:rows')
+  for tbl_name, in db.execute("select name from sqlite_schema where type='table'").fetchall():
+    cols = [row[1:3] for row in db.execute(f'pragma table_info("{tbl_name}")') if row[1] != 'id']
+    values = {'text': lambda: str(rng.random()), 'int': lambda: str(rng.randrange(1000)), 'real': rng.random, 'blob': lambda: b'x'*8}
+    rows = [[values.get(type_.lower(), lambda: None)() if not name.startswith('p') else None for name, type_ in cols] for _ in range(n_rows)]
+    db.executemany(f'insert into "{tbl_name}" ({",".join(name for name, _ in cols)}) values ({",".join("?"*len(cols))})', rows)
+  db.commit()
+
+def _run_phases(tmp_dir, n_rows=0, seed=0, **params):
+  source_sql, target_sql = synthetic_schema(seed=seed, **params), synthetic_schema(target=True, seed=seed, **params)
+  source_fn = os.path.join(tmp_dir, 'source.db')
+  db = sqlite3.connect(source_fn)
+  db.executescript(source_sql)
+  if n_rows:
+    _fill_synthetic_db(db, n_rows, seed=seed)
+  target_db = _open(target_sql)
+  create_tables = [row[0] for row in target_db.execute("select sql from sqlite_schema where type='table'")]
+  seconds = {}
+  seconds['parse'] = _timeit(lambda: [_parse_create_table(sql) for sql in create_tables])
+  seconds['load_sql'] = _timeit(lambda: _open(target_sql).close(), repeat=1)
+  seconds['introspect'] = _timeit(lambda: (_get_tables(db), _get_views(db)))
+  snapshot = pickle.dumps((_get_tables(db), _get_views(db), _get_tables(target_db), _get_views(target_db)))
+  best = None
+  for _ in range(3):
+    # _diff updates its first model in place, time it on fresh copies
+    models = pickle.loads(snapshot)
+    start = time.perf_counter()
+    changes = _diff(*models)
+    best = min(best or float('inf'), time.perf_counter() - start)
+  seconds['diff'] = best
+  db.close()
+  apply_fn = os.path.join(tmp_dir, 'apply.db')
+  shutil.copyfile(source_fn, apply_fn)
+  db = sqlite3.connect(apply_fn)
+  seconds['apply'] = _timeit(lambda: _apply(db, changes), repeat=1)
+  assert diff(apply_fn, target_sql, cache=False) == [], 'synthetic apply left differences'
+  db.close()
+  return seconds, len(changes)
+
+BENCH_SUITE = [
+  dict(n_tables=10, n_columns=10),
+  dict(n_tables=100, n_columns=10),
+  dict(n_tables=300, n_columns=10),
+  dict(n_tables=100, n_columns=100),
+  dict(n_tables=100, n_columns=10, comment_density=1, aka_density=.5),
+  dict(n_tables=100, n_columns=10, fk_fanout=5, n_views=200),
+  dict(n_tables=10, n_columns=10, n_rows=20000),
+]
+
+def _git_commit():
+  try:
+    commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], capture_output=True, text=True).stdout.strip())
+    return commit + ('+dirty' if dirty else '')
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def _previous_results():
+  previous = {}
+  if os.path.exists(BENCH_RESULTS):
+    with open(BENCH_RESULTS) as f:
+      for line in f:
+        result = json.loads(line)
+        previous[json.dumps(result['config'], sort_keys=True)] = result
+  return previous
+
+def _store_result(result):
+  with open(BENCH_RESULTS, 'a') as f:
+    f.write(json.dumps({
+      'commit': _git_commit(), 'time': datetime.datetime.now().isoformat(timespec='seconds'),
+      'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, **result,
+    })+'\n')
+
+def bench_suite():
+  '''
+  Times parse / load_sql / introspect / diff / apply on each BENCH_SUITE config of synthetic_schema(),
+  appends the results to BENCH_RESULTS (JSON lines) and compares them to the last stored run of the
+  same config, flagging phases more than REGRESSION_RATIO times slower.
+  '''
+  previous = _previous_results()
+  phases = ('parse', 'load_sql', 'introspect', 'diff', 'apply')
+  print('config\tchanges\t' + '\t'.join(phases))
+  for config in BENCH_SUITE:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+      seconds, n_changes = _run_phases(tmp_dir, **config)
+    key = json.dumps(config, sort_keys=True)
+    cells = []
+    for phase in phases:
+      cell = f'{seconds[phase]:.4f}'
+      if key in previous and previous[key]['seconds'].get(phase):
+        ratio = seconds[phase] / previous[key]['seconds'][phase]
+        cell += f' ({ratio:.2f}x{" REGRESSION" if ratio > REGRESSION_RATIO else ""})'
+      cells.append(cell)
+    print(' '.join(f'{k}={v}' for k, v in config.items()) + f'\t{n_changes}\t' + '\t'.join(cells))
+    _store_result({'config': config, 'changes': n_changes, 'seconds': seconds})
+  if previous:
+    print('(ratios against the previous run of each config in', BENCH_RESULTS+')')
+
+BENCH_MEMORY = [
+  dict(n_tables=1000, n_columns=20),
+  dict(n_tables=500, n_columns=40, comment_density=.3, aka_density=.1, fk_fanout=2),
+  dict(n_tables=100, n_columns=200, comment_density=1, aka_density=.5),
+]
+
+def _traced(f):
+  gc.collect()
+  tracemalloc.start()
+  result = f()
+  size = tracemalloc.get_traced_memory()[0]
+  tracemalloc.stop()
+  return size, result
+
+def bench_memory():
+  '''
+  Bytes per column the schema model holds for both sides of a diff of each BENCH_MEMORY config:
+  introspected, unpickled from the snapshot cache, and pickled.  Results are stored and compared
+  like bench_suite()'s.
+  '''
+  previous = _previous_results()
+  measures = ('introspected', 'unpickled', 'pickled')
+  print('config\tcolumns\t' + '\t'.join(measures))
+  for params in BENCH_MEMORY:
+    dbs = [_open(synthetic_schema(target=target, **params)) for target in (False, True)]
+    n_columns = sum(db.execute("select count(*) from sqlite_schema s join pragma_table_info(s.name) where s.type='table'").fetchone()[0] for db in dbs)
+    introspected, models = _traced(lambda: [(_get_tables(db), _get_views(db)) for db in dbs])
+    snapshots = [pickle.dumps(model) for model in models]
+    del models
+    unpickled, models = _traced(lambda: [pickle.loads(snapshot) for snapshot in snapshots])
+    per_column = dict(zip(measures, [n / n_columns for n in (introspected, unpickled, sum(map(len, snapshots)))]))
+    config = {'bench': 'memory', **params}
+    key = json.dumps(config, sort_keys=True)
+    cells = []
+    for measure in measures:
+      cell = f'{per_column[measure]:.0f}'
+      if key in previous and previous[key]['bytes_per_column'].get(measure):
+        cell += f' ({per_column[measure] / previous[key]["bytes_per_column"][measure]:.2f}x)'
+      cells.append(cell)
+    print(' '.join(f'{k}={v}' for k, v in params.items()) + f'\t{n_columns}\t' + '\t'.join(cells))
+    _store_result({'config': config, 'columns': n_columns, 'bytes_per_column': per_column})
+
+
+if __name__=='__main__':
+  names = sys.argv[1:] or [k[6:] for k in list(globals()) if k.startswith('bench_')]
+  for name in names:
+    print('==', name)
+    globals()['bench_'+name]()
@@ -1,62 +1,211 @@
-import collections, hashlib, os, re, shutil, sqlite3, sys, tempfile, time, uuid
-import magic
-import sqlparse
-import darp
+import collections, glob, hashlib, io, itertools, json, os, pickle, random, re, shutil, sqlite3, sys, tempfile, threading, time
 
 
-Table = collections.namedtuple('Table', 'name,tbl_name,rootpage,sql,columns,akas,unique_constraints,fks')
+Table = collections.namedtuple('Table', 'name,tbl_name,rootpage,sql,columns,akas,unique_constraints,fks,indexes,triggers')
 Column = collections.namedtuple('Column', 'cid,name,type,notnull,dflt_value,pk,col_def,akas')
 View = collections.namedtuple('View', 'name,tbl_name,rootpage,sql')
 ForeignKey = collections.namedtuple('ForeignKey', 'from_tbl,from_cols,to_tbl,to_cols,on_update,on_delete,match')
+Index = collections.namedtuple('Index', 'name,tbl_name,columns,unique,sql')
+
+REBUILD_REWRITE_THRESHOLD = 2 # rebuild a table when per-column ALTERs would rewrite it more often than this
+
+def _physical_memory():
+  try:
+    return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+  except (AttributeError, ValueError, OSError):
+    # not POSIX
+    return None
+
+# databases up to this size (a quarter of RAM, or 1 GiB where that's unknown) are dry run in RAM instead of a temp file copy
+MEMORY_DRY_RUN_LIMIT = (_physical_memory() or 4 * 1024**3) // 4
+
+ONLINE_BATCH_SIZE = 1000 # rows per copy batch of an online rebuild, unless a batch_size is given
+
+BUSY_TIMEOUT = 5000 # ms an apply waits for another connection's lock before backing off
+APPLY_RETRIES = 5 # times a transaction is retried, with exponential backoff, while the database stays locked
 
 AKA_RE = re.compile(r'AKA\[([A-Za-z0-9_, ]*)\]', re.IGNORECASE)
 
-def _open(s):
+def _is_sqlite_file(fn):
+  with open(fn, 'rb') as f:
+    return f.read(16) == b'SQLite format 3\x00'
+
+def _open(s, ddl_only=False):
   is_vaild_filename = re.sub(r'[^A-Za-z0-9._/\-]', '', s) and 'create table' not in s.lower()
   if is_vaild_filename:
-    file_type = magic.from_file(s)
-    if file_type == 'ASCII text':
-      db = sqlite3.connect(':memory:')
-      with open(s) as f:
-        sql = f.read()
-        for stmt in sqlparse.split(sql):
-          db.execute(stmt)
-      db.commit()
-      return db
-    if file_type.startswith('SQLite'):
+    if _is_sqlite_file(s):
       db = sqlite3.connect(s)
       return db
-    raise RuntimeError('unknown file type %s' % file_type)
+    try:
+      with open(s) as f:
+        return _load_sql(f, ddl_only=ddl_only)
+    except UnicodeDecodeError:
+      raise RuntimeError('unknown file type %s' % s)
   else:
-    db = sqlite3.connect(':memory:')
-    for stmt in sqlparse.split(s):
-      db.execute(stmt)
-    db.commit()
-    return db
+    return _load_sql(io.StringIO(s), ddl_only=ddl_only)
+
+_DDL_RE = re.compile(r'^\s*(?:(?:--[^\n]*(?:\n|$)|/\*.*?\*/)\s*)*(?:CREATE|ALTER|DROP)\b', re.IGNORECASE | re.DOTALL)
+# a run of comment-free non-DDL statements (the INSERTs of a dump), matched in one go so they never reach Python
+# ((?=(x+))\1 is an atomic x+, so a statement cut off at the end of a chunk fails fast instead of backtracking)
+_NON_DDL_RUN_RE = re.compile(r'''(?:\s*(?!(?:CREATE|ALTER|DROP)\b)[A-Za-z](?:(?=([^';"`\[\-/]+))\1|-(?!-)|/(?!\*)|'[^']*'|"[^"]*"|`[^`]*`|\[[^\]]*\])*;)+''', re.IGNORECASE)
+
+def _load_sql(f, ddl_only=False):
+  # with ddl_only, the INSERTs etc. of a full .dump are skipped, diff() only looks at the schema
+  db = sqlite3.connect(':memory:')
+  for stmt in _iter_statements(f, skip_re=_NON_DDL_RUN_RE if ddl_only else None):
+    if ddl_only and not _DDL_RE.match(stmt):
+      continue
+    db.execute(stmt)
+  db.commit()
+  return db
+
+def _iter_statements(f, chunk_size=1<<16, skip_re=None):
+  '''
+  Yields the SQL statements in file object f one at a time, reading it in chunks.  Every ';' is a
+  candidate boundary, sqlite3.complete_statement() decides if it really ends a statement (and not
+  a string, comment or trigger body).  Statements matched by skip_re at a statement boundary are
+  dropped without being yielded.
+  '''
+  buf = ''
+  for chunk in iter(lambda: f.read(chunk_size), ''):
+    start = len(buf)
+    buf += chunk
+    stmt_start = 0
+    while True:
+      if skip_re and (m := skip_re.match(buf, stmt_start)):
+        stmt_start = m.end()
+        start = max(start, stmt_start)
+      if (i := buf.find(';', start)) == -1:
+        break
+      stmt = buf[stmt_start:i+1]
+      if sqlite3.complete_statement(stmt):
+        yield stmt
+        stmt_start = i+1
+      start = i+1
+    buf = buf[stmt_start:]
+  if buf.strip():
+    yield buf
+
+SNAPSHOT_VERSION = 4 # bump whenever the pickled Table/Column/View/ForeignKey/Index model changes
+CACHE_DIR = os.path.join(os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'schema_evolve')
+CACHE_MAX_ENTRIES = 256
 
-def diff(fn1, fn2, apply=False):
-  db1 = _open(fn1)
-  db2 = _open(fn2)
+def _cache_key(s):
+  if not os.path.isfile(s):
+    # inline sql is cheap to parse and not worth a cache entry
+    return None
+  if _is_sqlite_file(s):
+    # the schema itself, not file identity plus schema_version: a database recreated (or restored
+    # from a backup) at the same path can reuse the inode with schema_version restarted
+    key = 'db:' + _schema_hash(s)
+  else:
+    with open(s, 'rb') as f:
+      key = 'sql:' + hashlib.sha256(f.read()).hexdigest()
+  return hashlib.sha256(f'{SNAPSHOT_VERSION}:{key}'.encode()).hexdigest()
+
+def _cache_get(key):
+  fn = os.path.join(CACHE_DIR, key+'.pickle')
+  try:
+    with open(fn, 'rb') as f:
+      snapshot = pickle.load(f)
+    os.utime(fn)
+    return snapshot
+  except (OSError, pickle.UnpicklingError, EOFError):
+    return None
 
+def _cache_put(key, snapshot):
+  try:
+    os.makedirs(CACHE_DIR, exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=CACHE_DIR)
+    with os.fdopen(fd, 'wb') as f:
+      pickle.dump(snapshot, f)
+    os.replace(tmp_fn, os.path.join(CACHE_DIR, key+'.pickle'))
+    _cache_evict()
+  except OSError:
+    pass
+
+def _cache_evict(max_entries=None):
+  max_entries = CACHE_MAX_ENTRIES if max_entries is None else max_entries
+  fns = [os.path.join(CACHE_DIR, fn) for fn in os.listdir(CACHE_DIR) if fn.endswith('.pickle')]
+  if len(fns) <= max_entries: return
+  fns.sort(key=lambda fn: os.stat(fn).st_mtime)
+  for fn in fns[:len(fns)-max_entries]:
+    os.remove(fn)
+
+def clear_cache():
+  if os.path.isdir(CACHE_DIR):
+    _cache_evict(0)
+
+def _load(s, cache=True, ddl_only=True):
+  key = _cache_key(s) if cache else None
+  if key and (snapshot := _cache_get(key)):
+    return snapshot
+  db = _open(s, ddl_only=ddl_only)
+  snapshot = _get_tables(db), _get_views(db)
+  db.close()
+  if key:
+    _cache_put(key, snapshot)
+  return snapshot
+
+def diff(fn1, fn2, apply=False, cache=True, rebuild=None, batch_size=0, ddl_only=True, online=False, optimize=True):
+  if apply:
+    db1 = _open(fn1)
+    tbls1, views1 = _get_tables(db1), _get_views(db1)
+  else:
+    tbls1, views1 = _load(fn1, cache=cache, ddl_only=ddl_only)
+  tbls2, views2 = _load(fn2, cache=cache, ddl_only=ddl_only)
+  cmds = _diff(tbls1, views1, tbls2, views2, rebuild=rebuild, online=online, optimize=optimize)
+  if apply:
+    _apply(db1, cmds, batch_size=batch_size or (ONLINE_BATCH_SIZE if online else 0))
+  return cmds
+
+FINGERPRINT_VERSION = 2 # bump when the canonical form below changes
+
+def fingerprint(s, cache=True):
+  '''
+  Stable sha256 of the schema model of s (a .db or .sql file, inline sql or an open connection), in
+  the terms diff() compares: columns, unique constraints, FKs, non-unique indexes and views, but not
+  comments, AKAs, whitespace, constraint or index names or rootpages.  Equal fingerprints mean diff() has nothing to do.
+  '''
+  if isinstance(s, sqlite3.Connection):
+    tbls, views = _get_tables(s), _get_views(s)
+  else:
+    tbls, views = _load(s, cache=cache)
+  model = {
+    'tables': {tbl.name: {
+      'columns': {col.name:[col.type, col.notnull, col.dflt_value, col.pk] for col in tbl.columns.values()},
+      'unique_constraints': sorted(tbl.unique_constraints.values()),
+      'fks': sorted(tbl.fks),
+      'indexes': sorted(_index_definition(index.sql) for index in tbl.indexes.values() if not index.unique),
+    } for tbl in tbls.values()},
+    'views': {view.name:' '.join(view.sql.split()) for view in views.values()},
+  }
+  canonical = json.dumps([FINGERPRINT_VERSION, model], sort_keys=True, separators=(',', ':'))
+  return hashlib.sha256(canonical.encode()).hexdigest()
+
+def _diff(tbls1, views1, tbls2, views2, rebuild=None, online=False, optimize=True):
+  # note: updates tbls1 in place as renames are planned
   cmds = []
-  
-  tbls1 = _get_tables(db1)
-  tbls2 = _get_tables(db2)
-  views1 = _get_views(db1)
-  views2 = _get_views(db2)
+  # the tables as they are before the plan, for _verify_plan() (tbls1 is updated below)
+  source, prev_tbl_names = (dict(tbls1) if optimize else None), {}
+  # renames already planned, which SQLite applies to the schema but not to the SQL captured in tbls1
+  plan_renames = {}
   
   # add table
   for tbl_name in sorted(tbls2.keys() - tbls1.keys()):
-    possible_prev_names = tbls2[tbl_name].akas & (tbls1.keys() - tbls2.keys())
+    possible_prev_names = (tbls1.keys() - tbls2.keys()) & tbls2[tbl_name].akas
     if len(possible_prev_names) > 1:
       raise RuntimeError(f'{tbl_name}\'s aka list has more than one possible previous name: {",".join(sorted(possible_prev_names))}')
     elif len(possible_prev_names) == 1:
       old_tbl_name = possible_prev_names.pop()
       cmds.append(f'ALTER TABLE "{old_tbl_name}" RENAME TO "{tbl_name}"')
+      plan_renames[old_tbl_name] = tbl_name
+      prev_tbl_names[tbl_name] = old_tbl_name
       tbls1[tbl_name] = tbls1[old_tbl_name]
       del tbls1[old_tbl_name]
     else:
       cmds.append(tbls2[tbl_name].sql)
+      cmds += [index.sql for _, index in sorted(tbls2[tbl_name].indexes.items())]
 
   # drop view
   for view_name in sorted(views1.keys() - views2.keys()):
@@ -70,20 +219,63 @@ def diff(fn1, fn2, apply=False):
     tbl1 = tbls1[tbl_name]
     tbl2 = tbls2[tbl_name]
     
-    # add columns
-    added_columns = set()
+    prev_col_names = {}
     for col_name in sorted(tbl2.columns.keys() - tbl1.columns.keys()):
-      possible_prev_names = tbl2.columns[col_name].akas & (tbl1.columns.keys() - tbl2.columns.keys())
+      possible_prev_names = (tbl1.columns.keys() - tbl2.columns.keys()) & tbl2.columns[col_name].akas
       if len(possible_prev_names) > 1:
         raise RuntimeError(f'{tbl_name}.{col_name}\'s aka list has more than one possible previous name: {",".join(sorted(possible_prev_names))}')
       elif len(possible_prev_names) == 1:
-        old_col_name = possible_prev_names.pop()
+        prev_col_names[col_name] = possible_prev_names.pop()
+
+    # rebuild the table once instead of rewriting it column by column
+    # (online, every rewrite goes through a rebuild, as only that can run alongside other writers)
+    rewrites = _count_rewrites(tbl1, tbl2, prev_col_names)
+    rebuild_tbl = rewrites > (0 if online else REBUILD_REWRITE_THRESHOLD) if rebuild is None else rebuild and rewrites > 0
+    if rebuild_tbl:
+      rebuild_cmds, unique_constraints, indexes = _rebuild_table(tbl1, tbl2, prev_col_names, online=online, plan_renames=plan_renames)
+
+    # indexes are matched by definition, not name
+    renames = {old_col_name:col_name for col_name, old_col_name in prev_col_names.items()}
+    index_defs1 = {name:_index_definition(index.sql, renames) for name, index in tbl1.indexes.items()}
+    indexes2 = {_index_definition(index.sql):index for index in tbl2.indexes.values() if not index.unique}
+    deferred_indexes = []
+    if not rebuild_tbl:
+      # drop the indexes that are going away, and those on columns a backfill rewrites until the data is
+      # final (SQLite can't drop an indexed column, and one sorted build beats updating the index row by row)
+      rewritten_cols = _rewritten_columns(tbl1, tbl2, prev_col_names)
+      indexes = {}
+      for name, index in sorted(tbl1.indexes.items()):
+        if index.unique:
+          constraint_columns = tuple(sorted(renames.get(col_name, col_name) for col_name in tbl1.unique_constraints[name]))
+          wanted = constraint_columns in set(tbl2.unique_constraints.values())
+          if not wanted or not _references_any(index.sql, rewritten_cols):
+            # the unique constraint diff below takes care of it
+            indexes[name] = index
+            continue
+        elif index_defs1[name] in indexes2 and not _references_any(index.sql, rewritten_cols):
+          indexes[name] = index
+          continue
+        cmds.append(f'DROP INDEX "{name}"')
+        if index.unique or index_defs1[name] in indexes2:
+          deferred_indexes.append(index)
+
+    # add columns
+    added_columns = set()
+    for col_name in sorted(tbl2.columns.keys() - tbl1.columns.keys()):
+      if col_name in prev_col_names:
+        old_col_name = prev_col_names[col_name]
         cmds.append(f'ALTER TABLE "{tbl_name}" RENAME COLUMN "{old_col_name}" TO "{col_name}"')
-        del tbl1.columns[old_col_name]
-      else:
+        plan_renames[old_col_name] = col_name
+        # keep it around under its new name, its definition may have changed too
+        tbl1.columns[col_name] = tbl1.columns.pop(old_col_name)._replace(name=col_name)
+      elif not rebuild_tbl:
         cmds += _add_column(tbl_name, tbl2.columns[col_name])
         added_columns.add((tbl_name, (col_name,)))
 
+    if rebuild_tbl:
+      cmds += rebuild_cmds
+      tbl1 = tbl1._replace(columns=dict(tbl2.columns), unique_constraints=unique_constraints, fks=set(tbl2.fks), indexes=indexes)
+
     # drop unique constraints
     for constraint_name, constraint_columns in tbl1.unique_constraints.items():
       if constraint_columns not in set(tbl2.unique_constraints.values()):
@@ -94,6 +286,9 @@ def diff(fn1, fn2, apply=False):
       cmds.append(f'ALTER TABLE "{tbl_name}" DROP COLUMN {col_name}')
     
     # change column defs
+    # (the data of every rebuilt column is copied over by a single backfill UPDATE below)
+    backfills = []
+    tmp_col_names_to_drop = []
     for col_name in sorted(tbl1.columns.keys() & tbl2.columns.keys()):
       col1 = tbl1.columns[col_name]
       col2 = tbl2.columns[col_name]
@@ -102,14 +297,8 @@ def diff(fn1, fn2, apply=False):
         cmds.append(f'ALTER TABLE "{tbl_name}" RENAME COLUMN "{col_name}" TO {tmp_col_name}')
         cmds += _add_column(tbl_name, col2)
         cast_stmt = f'CAST({tmp_col_name} as {col2.type})'
-        cmds.append(f'UPDATE "{tbl_name}" SET "{col_name}" = '+ (f'COALESCE({cast_stmt}, {col2.dflt_value})' if col2.dflt_value else cast_stmt))
-        cmds.append(f'ALTER TABLE "{tbl_name}" DROP COLUMN {tmp_col_name}')
-    
-    # add unique constraints
-    for constraint_columns in sorted(set(tbl2.unique_constraints.values()) - set(tbl1.unique_constraints.values())):
-      constraint_name = 'unique_index_%i' % len(tbl2.unique_constraints)
-      constraint_columns_sql = ','.join(['"%s"'%s for s in constraint_columns])
-      cmds.append(f'CREATE UNIQUE INDEX {constraint_name} ON {tbl_name}({constraint_columns_sql})')
+        backfills.append((col_name, f'COALESCE({cast_stmt}, {col2.dflt_value})' if col2.dflt_value else cast_stmt))
+        tmp_col_names_to_drop.append(tmp_col_name)
     
     # drop foreign keys
     for fk in sorted(tbl1.fks - tbl2.fks):
@@ -118,9 +307,8 @@ def diff(fn1, fn2, apply=False):
         cmds.append(f'ALTER TABLE "{fk.from_tbl}" RENAME COLUMN "{col_name}" TO {tmp_col_name}')
         column = tbls2[fk.from_tbl].columns[col_name]
         cmds += _add_column(fk.from_tbl, column)
-        cmds.append(f'UPDATE "{fk.from_tbl}" SET "{col_name}" = "{tmp_col_name}"')
-        for tmp_col_name in tmp_col_names:
-          cmds.append(f'ALTER TABLE "{tbl_name}" DROP COLUMN {tmp_col_name}')
+        backfills.append((col_name, f'"{tmp_col_name}"'))
+      tmp_col_names_to_drop += tmp_col_names
 
     # add foreign keys
     fks_to_add = sorted(tbl2.fks - tbl1.fks)
@@ -141,33 +329,721 @@ def diff(fn1, fn2, apply=False):
             to_cols_combined = ','.join([f'"{cname}"' for cname in fk.to_cols])
             cmds_to_add[-1] += f' references "{fk.to_tbl}"({to_cols_combined})'
           cmds += cmds_to_add
-          cmds.append(f'UPDATE "{fk.from_tbl}" SET "{col_name}" = "{tmp_col_name}"')
-            
-        for tmp_col_name in tmp_col_names:
-          cmds.append(f'ALTER TABLE "{tbl_name}" DROP COLUMN {tmp_col_name}')
+          backfills.append((col_name, f'"{tmp_col_name}"'))
+        tmp_col_names_to_drop += tmp_col_names
+
+    # backfill all rebuilt columns in one pass over the table
+    if backfills:
+      # a column both retyped and losing or gaining an FK keeps its first (CAST) backfill
+      set_exprs = {}
+      for col_name, expr in backfills:
+        set_exprs.setdefault(col_name, expr)
+      set_stmts = ', '.join([f'"{col_name}" = {expr}' for col_name, expr in set_exprs.items()])
+      cmds.append(f'UPDATE "{tbl_name}" SET {set_stmts}')
+    for tmp_col_name in tmp_col_names_to_drop:
+      cmds.append(f'ALTER TABLE "{tbl_name}" DROP COLUMN {tmp_col_name}')
+    if fks_to_add:
       cmds.append('PRAGMA foreign_keys=on')
+    
+    # add unique constraints
+    for constraint_columns in sorted(set(tbl2.unique_constraints.values()) - set(tbl1.unique_constraints.values())):
+      constraint_name = 'unique_index_%i' % len(tbl2.unique_constraints)
+      constraint_columns_sql = ','.join(['"%s"'%s for s in constraint_columns])
+      cmds.append(f'CREATE UNIQUE INDEX {constraint_name} ON {tbl_name}({constraint_columns_sql})')
+
+    # build the deferred and new indexes on the final data
+    sql_renames = {tbl1.name:tbl_name, **renames} if tbl1.name!=tbl_name else renames
+    for index in deferred_indexes:
+      cmds.append(_rename_identifiers(index.sql, sql_renames))
+    existing_index_defs = {index_defs1.get(index.name) or _index_definition(index.sql) for index in list(indexes.values()) + deferred_indexes}
+    for index in sorted(indexes2.values()):
+      if _index_definition(index.sql) not in existing_index_defs:
+        cmds.append(index.sql)
       
 
   # add view
   for view_name in sorted(views2.keys() - views1.keys()):
     cmds.append(views2[view_name].sql)
   
-  if apply:
-    for cmd in cmds:
-      db1.execute(cmd)
-    db1.commit()
-  
-  return cmds
+  if not optimize:
+    return Plan(cmds)
+  plan = _optimize(cmds)
+  if plan.restructured:
+    _verify_plan(source, prev_tbl_names, plan, cmds, tbls2)
+  return plan
+
+class Plan(list):
+  '''
+  The commands of a migration, plus what _optimize() saved: statements removed, and how many of
+  those rewrote a whole table.  restructured is the set of tables whose columns' rename sequences
+  were changed (and checked by _verify_plan()), as opposed to only redundant pragmas dropped.
+  '''
+  def __init__(self, cmds=(), statements_saved=0, rewrites_saved=0, restructured=frozenset()):
+    super().__init__(cmds)
+    self.statements_saved = statements_saved
+    self.rewrites_saved = rewrites_saved
+    self.restructured = restructured
+
+_PRAGMA_RE = re.compile(r'^PRAGMA (\w+)\s*=\s*(\w+)$', re.IGNORECASE)
+_COLUMN_NAME = r'("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s"`\[]+)'
+_RENAME_COLUMN_RE = re.compile(rf'^ALTER TABLE "([^"]+)" RENAME COLUMN {_COLUMN_NAME} TO {_COLUMN_NAME}$')
+_ADD_COLUMN_RE = re.compile(rf'^ALTER TABLE "([^"]+)" ADD COLUMN {_COLUMN_NAME}')
+_DROP_COLUMN_RE = re.compile(rf'^ALTER TABLE "([^"]+)" DROP COLUMN {_COLUMN_NAME}$')
+
+def _optimize(cmds):
+  '''
+  Peephole pass over a plan from _diff(), which emits each table's changes branch by branch:
+  - a column renamed twice in a row (an AKA rename, then to a temp name) is renamed once;
+  - a column moved to the same temp name by both the column def and the FK branch is moved once,
+    dropping the first branch's placeholder ADD COLUMN and the second DROP COLUMN of the temp copy
+    (which would otherwise fail on the duplicate name);
+  - a PRAGMA overridden by the next command, or setting what's already set, is dropped (the
+    foreign_keys=on/off pairs between consecutive tables).
+  Returns a Plan.
+  '''
+  out = []
+  restructured = set()
+  tmp_renames = {} # (tbl, temp column) -> its RENAME COLUMN, until the temp column is dropped
+  extra_drops = collections.Counter()
+  for cmd in cmds:
+    if m := _RENAME_COLUMN_RE.match(cmd):
+      tbl_name, old, new = m.group(1), _unquote_identifier(m.group(2)), _unquote_identifier(m.group(3))
+      if (prev := _last_rename(out, tbl_name, old)) is not None:
+        # x -> old, old -> new: x -> new
+        x = _unquote_identifier(_RENAME_COLUMN_RE.match(out[prev]).group(2))
+        del out[prev]
+        restructured.add(tbl_name)
+        if x == new:
+          continue
+        cmd, old = f'ALTER TABLE "{tbl_name}" RENAME COLUMN "{x}" TO {m.group(3)}', x
+      if new.startswith('__tmp_col_') and (tbl_name, new) in tmp_renames:
+        added = _last_add(out, tbl_name, old, tmp_renames[tbl_name, new])
+        if added is not None:
+          # the column added since its first move holds no data yet, the branch re-adding it wins
+          del out[added]
+          extra_drops[tbl_name, new] += 1
+          restructured.add(tbl_name)
+          continue
+      if new.startswith('__tmp_col_'):
+        tmp_renames[tbl_name, new] = cmd
+    elif m := _DROP_COLUMN_RE.match(cmd):
+      key = m.group(1), _unquote_identifier(m.group(2))
+      if extra_drops[key] and key not in tmp_renames:
+        extra_drops[key] -= 1
+        continue
+      tmp_renames.pop(key, None)
+    elif m := _PRAGMA_RE.match(cmd):
+      while out and (prev := _PRAGMA_RE.match(out[-1])) and prev.group(1).lower()==m.group(1).lower():
+        out.pop()
+    out.append(cmd)
+
+  # drop pragmas that set what's already set
+  plan = []
+  pragmas = {}
+  for cmd in out:
+    if m := _PRAGMA_RE.match(cmd):
+      name, value = m.group(1).lower(), m.group(2).lower()
+      if pragmas.get(name)==value:
+        continue
+      pragmas[name] = value
+    plan.append(cmd)
+
+  removed = collections.Counter(cmds)
+  removed.subtract(plan)
+  rewrites_saved = sum(n for cmd, n in removed.items() if n > 0 and (m := _COST_CLASS_RE.match(cmd)) and m.lastgroup in ('rewrite', 'copy'))
+  return Plan(plan, len(cmds)-len(plan), rewrites_saved, restructured)
+
+def _last_rename(out, tbl_name, col_name):
+  '''The index of the RENAME COLUMN in out that named tbl_name.col_name, if nothing since refers to the column or changes pragmas.'''
+  for i in range(len(out)-1, -1, -1):
+    m = _RENAME_COLUMN_RE.match(out[i])
+    if m and m.group(1)==tbl_name and _unquote_identifier(m.group(3))==col_name:
+      return i
+    if _PRAGMA_RE.match(out[i]) or _other_table(out[i], tbl_name) or _references_any(out[i], [col_name]):
+      return None
+  return None
+
+def _last_add(out, tbl_name, col_name, since):
+  '''The index of the ADD COLUMN of tbl_name.col_name in out after the command since, if nothing in between refers to the column.'''
+  for i in range(len(out)-1, -1, -1):
+    if out[i]==since:
+      return None
+    m = _ADD_COLUMN_RE.match(out[i])
+    if m and m.group(1)==tbl_name and _unquote_identifier(m.group(2))==col_name:
+      return i
+    if _other_table(out[i], tbl_name) or _references_any(out[i], [col_name]):
+      return None
+  return None
+
+def _other_table(cmd, tbl_name):
+  m = _STEP_TABLE_RE.match(cmd)
+  return m is not None and m.group(1)!=tbl_name
+
+_DROP_INDEX_RE = re.compile(r'^DROP INDEX ("(?:[^"]|"")*"|\S+)$')
+
+def _verify_plan(source, prev_tbl_names, plan, cmds, tbls2):
+  '''
+  Checks that an optimized plan leaves the same schema as the plan it came from by running both on
+  schema only copies of the tables it restructured (source being the tables before the plan, by
+  their names then) and re-diffing the results.  Only those tables' statements are replayed, so
+  the check costs what they do, however big the rest of the schema.  If the original plan fails,
+  the optimized one has to reach the target.
+  '''
+  tbl_names = set(plan.restructured) | {prev_tbl_names[name] for name in plan.restructured if name in prev_tbl_names}
+  tbls = [source[name] for name in sorted(tbl_names & source.keys())]
+  index_names = {name for tbl in tbls for name in [*tbl.indexes, *tbl.unique_constraints]}
+  def touches(cmd):
+    if _PRAGMA_RE.match(cmd):
+      return True
+    if m := _DROP_INDEX_RE.match(cmd):
+      return _unquote_identifier(m.group(1)) in index_names
+    m = _STEP_TABLE_RE.match(cmd)
+    return m is not None and m.group(1) in tbl_names
+  def run(cmds):
+    db = sqlite3.connect(':memory:')
+    for tbl in tbls:
+      db.execute(tbl.sql)
+      for index in tbl.indexes.values():
+        db.execute(index.sql)
+    _apply(db, [cmd for cmd in cmds if touches(cmd)])
+    return _get_tables(db), _get_views(db)
+  optimized = run(plan)
+  try:
+    expected = run(cmds)
+  except sqlite3.Error:
+    expected = {name:tbls2[name] for name in plan.restructured if name in tbls2}, {}
+  if remaining := _diff(*optimized, *expected, optimize=False):
+    raise RuntimeError(f'optimized plan leaves a different schema, re-diff: {remaining}')
+
+_BACKFILL_RE = re.compile(r'^(?:UPDATE "(?P<tbl>[^"]+)" SET .*|INSERT INTO "(?P<dst_tbl>[^"]+)" \((?P<rowid>rowid,)?[^)]*\) SELECT .* FROM "(?P<src_tbl>[^"]+)"|DELETE FROM "(?P<del_tbl>__old_tbl_[^"]+)")$', re.DOTALL)
+_TRANSACTION_RE = re.compile(r'^(?:BEGIN IMMEDIATE|COMMIT)$')
+
+_FOREIGN_KEYS_PRAGMA_RE = re.compile(r'^PRAGMA foreign_keys\s*=\s*(\w+)$', re.IGNORECASE)
+_STEP_TABLE_RE = re.compile(r'^(?:ALTER TABLE|UPDATE|INSERT INTO|CREATE TABLE|DROP TABLE|CREATE (?:UNIQUE )?INDEX \S+ ON)\s+"?([^"\s(]+)', re.IGNORECASE)
+
+class LockStats:
+  '''
+  What an apply did to other writers: how long it held SQLite's write lock (in total, and at most
+  at once, which bounds how long it could have blocked a writer) and how long it waited for them.
+  '''
+  def __init__(self):
+    self.transactions = 0
+    self.held = 0.
+    self.max_held = 0.
+    self.waited = 0.
+    self.retries = 0
+    self.over_budget = 0
+
+  def __repr__(self):
+    return f'LockStats(transactions={self.transactions}, held={self.held:.3f}s, max_held={self.max_held:.3f}s, waited={self.waited:.3f}s, retries={self.retries}, over_budget={self.over_budget})'
+
+StatementMetrics = collections.namedtuple('StatementMetrics', 'stage,statement,seconds,rows_changed,db_growth,wal_growth,journal_growth,lock_wait,error')
+
+def jsonl_metrics(fn, **fields):
+  '''
+  A metrics callback appending each StatementMetrics, plus any fields given (like the db of a
+  fleet's worker), as a line of JSON to the file fn.
+  '''
+  def write(m):
+    with open(fn, 'a') as f:
+      f.write(json.dumps({**fields, **m._asdict()})+'\n')
+  return write
+
+class _Meter:
+  '''
+  Measures each statement an apply runs, for a metrics callback: wall time, rows changed (both of
+  this connection only), growth of the database, its WAL and its rollback journal in bytes, and
+  time spent waiting for other writers' locks (since the previous statement, so BEGIN's wait
+  counts towards the first).
+  '''
+  def __init__(self, db, stage, callback, stats):
+    self.db, self.stage, self.callback, self.stats = db, stage, callback, stats
+    self.fn = next((row[2] for row in db.execute('PRAGMA database_list') if row[1]=='main'), '')
+    self.page_size = db.execute('PRAGMA page_size').fetchone()[0]
+    self.waited = stats.waited
+
+  def _snapshot(self):
+    sizes = [os.path.getsize(fn) if os.path.exists(fn) else 0 for fn in (self.fn+'-wal', self.fn+'-journal')] if self.fn else [0, 0]
+    page_count = self.db.execute('PRAGMA page_count').fetchone()[0]
+    return [time.perf_counter(), self.db.total_changes, page_count*self.page_size] + sizes
+
+  def __bool__(self):
+    return bool(self.callback)
+
+  def __call__(self, cmd, f):
+    if not self.callback:
+      return f()
+    before = self._snapshot()
+    error = None
+    try:
+      return f()
+    except BaseException as e:
+      error = f'{type(e).__name__}: {e}'
+      raise
+    finally:
+      after = self._snapshot()
+      seconds, rows_changed, db_growth, wal_growth, journal_growth = [b-a for a, b in zip(before, after)]
+      lock_wait, self.waited = self.stats.waited - self.waited, self.stats.waited
+      self.callback(StatementMetrics(self.stage, cmd, seconds, rows_changed, db_growth, wal_growth, journal_growth, lock_wait, error))
+
+def _apply(db, cmds, batch_size=0, checkpoint='PASSIVE', echo=None, lock_budget=None, retries=APPLY_RETRIES, metrics=None, stage='apply'):
+  '''
+  Applies a plan from diff() inside a single BEGIN IMMEDIATE transaction (one journal flush, and
+  all or nothing on error), with a savepoint around each step (the run of commands on one table).
+  PRAGMA foreign_keys is a no-op inside a transaction, so the plan's toggles are hoisted out: FKs
+  are turned off before BEGIN and set to the plan's final value after COMMIT.
+  Batched backfills (see _execute) commit per batch, so a batch_size or a lock_budget (ms, which
+  can't be kept by one long transaction) falls back to running the plan statement by statement.
+  Only an online rebuild's triggers keep up with writes made in between, so a plan with any other
+  backfill holds the database exclusively until it's done (see _hold_exclusive).
+  metrics, if given, is called with a StatementMetrics (see _Meter) after every statement.
+  Returns the LockStats.
+  '''
+  stats = LockStats()
+  db.commit()
+  meter = _Meter(db, stage, metrics, stats)
+  if batch_size or lock_budget:
+    block = None
+    def run_block(block):
+      for cmd in block:
+        meter(cmd, lambda: db.execute(cmd))
+    exclusive = any(_is_offline_backfill(cmd) for cmd in cmds)
+    if exclusive:
+      _hold_exclusive(db, True)
+    try:
+      for cmd in cmds:
+        if echo: echo(cmd)
+        if cmd == 'BEGIN IMMEDIATE':
+          # an online rebuild's swap, keep it one transaction
+          block = []
+        elif cmd == 'COMMIT':
+          _yield_lock(_transaction(db, lambda: run_block(block), stats, lock_budget=lock_budget, retries=retries, meter=meter), lock_budget)
+          block = None
+        elif block is not None:
+          block.append(cmd)
+        else:
+          meter(cmd, lambda: _execute(db, cmd, batch_size=batch_size or ONLINE_BATCH_SIZE, checkpoint=checkpoint, lock_budget=lock_budget, retries=retries, stats=stats))
+    finally:
+      if exclusive:
+        _hold_exclusive(db, False)
+    return stats
+  fk_pragmas = [cmd for cmd in cmds if _FOREIGN_KEYS_PRAGMA_RE.match(cmd)]
+  # an online rebuild's swap transaction is subsumed by the whole plan's
+  cmds = [cmd for cmd in cmds if not _FOREIGN_KEYS_PRAGMA_RE.match(cmd) and not _TRANSACTION_RE.match(cmd)]
+  def run():
+    for i, step in enumerate(_steps(cmds)):
+      db.execute(f'SAVEPOINT step_{i}')
+      for cmd in step:
+        if echo: echo(cmd)
+        meter(cmd, lambda: db.execute(cmd))
+      db.execute(f'RELEASE step_{i}')
+  isolation_level = db.isolation_level
+  db.isolation_level = None
+  try:
+    foreign_keys = db.execute('PRAGMA foreign_keys').fetchone()[0]
+    if fk_pragmas:
+      db.execute('PRAGMA foreign_keys=off')
+    try:
+      _transaction(db, run, stats, retries=retries, meter=meter)
+    except BaseException:
+      db.execute(f'PRAGMA foreign_keys={foreign_keys}')
+      raise
+    if fk_pragmas:
+      db.execute(fk_pragmas[-1])
+  finally:
+    db.isolation_level = isolation_level
+  return stats
+
+def _transaction(db, cmds, stats, lock_budget=None, retries=APPLY_RETRIES, meter=None):
+  '''
+  Runs cmds (a list of (sql, params), or a function) in one BEGIN IMMEDIATE transaction.  While
+  another connection holds the lock past the busy timeout, the transaction is rolled back and
+  retried with exponential backoff, up to `retries` times.  Returns how long the lock was held.
+  A meter (see _Meter) measures the COMMIT, where a WAL database does most of its writing.
+  '''
+  for attempt in range(retries+1):
+    start = time.perf_counter()
+    locked = None
+    try:
+      db.execute('BEGIN IMMEDIATE')
+      locked = time.perf_counter()
+      if callable(cmds):
+        cmds()
+      else:
+        for sql, params in cmds:
+          db.execute(sql, params)
+      if meter:
+        meter('COMMIT', lambda: db.execute('COMMIT'))
+      else:
+        db.execute('COMMIT')
+      break
+    except BaseException as e:
+      if db.in_transaction:
+        db.execute('ROLLBACK')
+      if not _is_busy(e) or attempt == retries:
+        raise
+    finally:
+      end = time.perf_counter()
+      stats.waited += (locked or end) - start
+      if locked:
+        held = end - locked
+        stats.transactions += 1
+        stats.held += held
+        stats.max_held = max(stats.max_held, held)
+        stats.over_budget += bool(lock_budget and held > lock_budget/1000)
+    stats.retries += 1
+    backoff = min(1., .05 * 2**attempt) * random.uniform(.5, 1)
+    time.sleep(backoff)
+    stats.waited += backoff
+  return held
+
+def _is_offline_backfill(cmd):
+  # a backfill UPDATE or an offline rebuild's copy, whose rows go stale if another connection writes
+  # before the plan is through (an online rebuild's copy keeps rowids, and triggers keep it in sync)
+  m = _BACKFILL_RE.match(cmd)
+  return bool(m) and not m.group('rowid') and not m.group('del_tbl')
+
+def _hold_exclusive(db, hold):
+  '''
+  In EXCLUSIVE locking mode a connection keeps its lock from one transaction to the next, so no
+  other connection reads or writes in between.  Back in NORMAL mode the lock is only let go on the
+  next access to the database.
+  '''
+  db.execute(f'PRAGMA locking_mode={"EXCLUSIVE" if hold else "NORMAL"}')
+  if not hold:
+    db.execute('SELECT 1 FROM sqlite_schema LIMIT 1').fetchall()
+
+def _is_busy(e):
+  return isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e))
+
+def _yield_lock(held, lock_budget):
+  # leave the lock free for as long as it was held, so writers polling in their busy handlers get their turn
+  if lock_budget:
+    time.sleep(held)
+
+def _steps(cmds):
+  '''Splits a plan into runs of consecutive commands on the same table (a table rebuild's temp tables count as the table).'''
+  steps = []
+  tbl_name = None
+  for cmd in cmds:
+    m = _STEP_TABLE_RE.match(cmd)
+    cmd_tbl_name = m.group(1) if m and not m.group(1).startswith(('__tmp_tbl_', '__old_tbl_')) else None
+    if not steps or (cmd_tbl_name and cmd_tbl_name != tbl_name):
+      steps.append([])
+      tbl_name = cmd_tbl_name or tbl_name
+    steps[-1].append(cmd)
+  return steps
+
+def _execute(db, cmd, batch_size=0, checkpoint='PASSIVE', lock_budget=None, retries=APPLY_RETRIES, stats=None):
+  '''
+  Runs one planned statement in its own transaction (see _transaction).  With a batch_size, the
+  whole-table backfills diff() generates (UPDATE ... SET, the table rebuild's INSERT ... SELECT and
+  the online rebuild's emptying of the old table) run in rowid ranges of at most batch_size rows,
+  each in its own transaction followed by a WAL checkpoint, so neither the write lock nor the WAL
+  ever covers more than one batch.  With a lock_budget (ms), the batch size adapts so each batch
+  holds the lock for at most about that long, and the lock is left free after each batch.
+  An online rebuild's copy (one that keeps rowids) first clears each range in the new table, as
+  triggers may have mirrored rows into it.
+  '''
+  stats = LockStats() if stats is None else stats
+  db.commit()
+  if cmd.startswith(('PRAGMA', '--')):
+    # pragmas like foreign_keys are no-ops inside a transaction
+    db.execute(cmd)
+    return stats
+  m = _BACKFILL_RE.match(cmd) if batch_size else None
+  if m:
+    tbl_name = m.group('tbl') or m.group('src_tbl') or m.group('del_tbl')
+    try:
+      start = db.execute(f'SELECT min(rowid) FROM "{tbl_name}"').fetchone()[0]
+    except sqlite3.OperationalError:
+      # WITHOUT ROWID table
+      m = None
+  if not m:
+    _yield_lock(_transaction(db, [(cmd, ())], stats, lock_budget=lock_budget, retries=retries), lock_budget)
+    return stats
+  while start is not None:
+    row = db.execute(f'SELECT rowid FROM "{tbl_name}" WHERE rowid >= ? ORDER BY rowid LIMIT 1 OFFSET ?', (start, batch_size)).fetchone()
+    end = row[0] if row else None
+    where, params = (' WHERE rowid >= ?', (start,)) if end is None else (' WHERE rowid >= ? AND rowid < ?', (start, end))
+    batch = [(cmd+where, params)]
+    if m.group('rowid'):
+      batch.insert(0, (f'DELETE FROM "{m.group("dst_tbl")}"'+where, params))
+    held = _transaction(db, batch, stats, lock_budget=lock_budget, retries=retries)
+    if checkpoint:
+      db.execute(f'PRAGMA wal_checkpoint({checkpoint})')
+    if lock_budget:
+      if held > lock_budget/1000:
+        batch_size = max(1, batch_size//2)
+      elif held < lock_budget/4000:
+        batch_size *= 2
+    _yield_lock(held, lock_budget)
+    start = end
+  return stats
+
+# seconds per page of a table (and its indexes) a command reads, measured with SQLite 3.40, 4KiB pages and a warm page cache
+COST_SECONDS_PER_PAGE = {'metadata': 0., 'rewrite': 50e-6, 'copy': 100e-6, 'index': 50e-6, 'delete': 20e-6, 'drop': 30e-6}
+
+CommandCost = collections.namedtuple('CommandCost', 'statement,cost_class,tbl_name,rows,pages,seconds,disk')
+_TableSize = collections.namedtuple('_TableSize', 'rows,pages,index_pages,columns')
+
+_COST_CLASS_RE = re.compile(r'^(?:(?P<rewrite>UPDATE|ALTER TABLE (?:"[^"]*"|\S+) DROP COLUMN)|(?P<copy>INSERT INTO .* SELECT)|(?P<delete>DELETE FROM)|(?P<drop>DROP TABLE)|(?P<index>CREATE (?:UNIQUE )?INDEX))\b', re.IGNORECASE | re.DOTALL)
+_RENAME_TABLE_RE = re.compile(r'^ALTER TABLE "([^"]+)" RENAME TO "([^"]+)"$')
+
+def estimate(db, cmds, dbstat=False):
+  '''
+  Estimates what each command of a plan from diff() will cost on db before it runs, as a list of
+  CommandCost.  cost_class is 'metadata' for commands that only touch the schema (ADD COLUMN,
+  renames, views, triggers, pragmas), 'rewrite' for those rewriting every row of a table in place
+  (backfill UPDATEs, DROP COLUMN), 'copy' for a rebuild's INSERT ... SELECT, 'index' for index
+  builds, and 'delete' and 'drop' for emptying and dropping tables.  rows and pages are what the
+  command reads, seconds is pages times COST_SECONDS_PER_PAGE, and disk is the bytes it writes
+  (new pages plus their copies in the WAL or rollback journal), which sum to the free space a
+  single transaction apply needs.  Batched applies checkpoint as they go and need less.  dbstat
+  measures every table's pages exactly, by reading them all (see _table_sizes).
+  '''
+  sizes = _table_sizes(db, dbstat=dbstat)
+  page_size = db.execute('PRAGMA page_size').fetchone()[0]
+  costs = []
+  for cmd in cmds:
+    m = _COST_CLASS_RE.match(cmd)
+    cost_class = m.lastgroup if m else 'metadata'
+    backfill = _BACKFILL_RE.match(cmd)
+    if backfill:
+      tbl_name = backfill.group('tbl') or backfill.group('src_tbl') or backfill.group('del_tbl')
+    else:
+      step = _STEP_TABLE_RE.match(cmd)
+      tbl_name = step.group(1) if step else None
+    # tables the plan creates start out empty
+    size = sizes.get(tbl_name, _TableSize(0, 0, 0, 0))
+    pages = written = 0
+    if cost_class in ('rewrite', 'delete'):
+      pages = written = size.pages + size.index_pages
+    elif cost_class == 'copy':
+      pages, written = size.pages, 2*size.pages
+      if backfill:
+        sizes[backfill.group('dst_tbl')] = size._replace(index_pages=0)
+    elif cost_class == 'index':
+      # an index is about as big as the share of the table's columns it holds (plus the rowid)
+      index_columns = cmd[cmd.find('(', m.end()):].count(',') + 1
+      index_pages = size.pages * (index_columns+1) // (size.columns+1)
+      pages, written = size.pages, 2*index_pages
+      if tbl_name in sizes:
+        sizes[tbl_name] = size._replace(index_pages=size.index_pages+index_pages)
+    elif cost_class == 'drop':
+      pages = size.pages + size.index_pages
+      sizes.pop(tbl_name, None)
+    elif (rename := _RENAME_TABLE_RE.match(cmd)) and rename.group(1) in sizes:
+      sizes[rename.group(2)] = sizes.pop(rename.group(1))
+    rows = size.rows if cost_class!='metadata' else 0
+    costs.append(CommandCost(cmd, cost_class, tbl_name, rows, pages, pages*COST_SECONDS_PER_PAGE[cost_class], written*page_size))
+  return costs
+
+def _table_sizes(db, dbstat=False):
+  '''
+  The rows, pages (of the table, and of its indexes) and column count of each table in db.  Row
+  counts come from sqlite_stat1 where ANALYZE filled it in, otherwise from max(rowid), an index
+  lookup that overcounts only by deleted rows (and is None for WITHOUT ROWID tables).  PRAGMA
+  page_count is split between the tables by their row counts (indexes included), unless dbstat is
+  set and SQLite was built with the dbstat virtual table, which has the exact page counts but
+  reads every page of the database to get them.
+  '''
+  tbl_names = dict(db.execute("select name, tbl_name from sqlite_schema where type in ('table', 'index')").fetchall())
+  columns = dict(db.execute("select m.name, count(*) from sqlite_schema m join pragma_table_info(m.name) where m.type='table' group by m.name").fetchall())
+  rows = {}
+  try:
+    for tbl_name, stat in db.execute('select tbl, stat from sqlite_stat1'):
+      rows[tbl_name] = max(rows.get(tbl_name, 0), int(stat.split()[0]))
+  except sqlite3.OperationalError:
+    # never analyzed
+    pass
+  for tbl_name in columns.keys() - rows.keys():
+    try:
+      rows[tbl_name] = db.execute(f'select max(rowid) from "{tbl_name}"').fetchone()[0] or 0
+    except sqlite3.OperationalError:
+      rows[tbl_name] = None
+  pages = collections.Counter()
+  index_pages = collections.Counter()
+  if dbstat:
+    try:
+      page_size = db.execute('PRAGMA page_size').fetchone()[0]
+      for name, size in db.execute('select name, sum(pgsize) from dbstat where aggregate=TRUE group by name'):
+        tbl_name = tbl_names.get(name)
+        (pages if name==tbl_name else index_pages)[tbl_name] += size // page_size
+    except sqlite3.OperationalError:
+      # no dbstat (or one older than 3.31)
+      dbstat = False
+  if not dbstat:
+    page_count = db.execute('PRAGMA page_count').fetchone()[0]
+    total_rows = sum(n or 0 for n in rows.values())
+    for tbl_name in columns:
+      pages[tbl_name] = page_count * (rows[tbl_name] or 0) // total_rows if total_rows else page_count // max(1, len(columns))
+  return {tbl_name:_TableSize(rows.get(tbl_name), pages[tbl_name], index_pages[tbl_name], n) for tbl_name, n in columns.items()}
+
+def _format_cost(cost):
+  if cost.cost_class=='metadata':
+    return ''
+  rows = '?' if cost.rows is None else f'{cost.rows:,}'
+  return f' -- {cost.cost_class}: ~{rows} rows, {cost.pages:,} pages, ~{cost.seconds:.1f}s'
+
+ColumnCheck = collections.namedtuple('ColumnCheck', 'tbl_name,col_name,from_type,to_type,rows,changed,defaulted,not_null')
+
+def preflight(db, tbls2):
+  '''
+  Checks what converting the data in db to the column definitions of tbls2 would do, without
+  copying or rewriting anything: a single aggregate query per table counts, for all of its
+  changed columns at once, the rows whose value the backfill's CAST changes (like 'abc' or 1.5
+  to INT, or '2020-01-01' to DATETIME), the NULLs it replaces with the new default, and the NULLs
+  left in a NOT NULL column (which make the backfill fail).  Returns a ColumnCheck per changed
+  column, named as in tbls2.
+  '''
+  tbls1 = _get_tables(db)
+  checks = []
+  for tbl_name, tbl2 in sorted(tbls2.items()):
+    tbl1 = tbls1.get(tbl_name)
+    if tbl1 is None:
+      possible_prev_names = (tbls1.keys() - tbls2.keys()) & tbl2.akas
+      if len(possible_prev_names) != 1: continue # a new table
+      tbl1 = tbls1[possible_prev_names.pop()]
+    cols, sums = [], []
+    for col_name, col2 in tbl2.columns.items():
+      col1 = tbl1.columns.get(col_name)
+      if col1 is None:
+        possible_prev_names = (tbl1.columns.keys() - tbl2.columns.keys()) & col2.akas
+        if len(possible_prev_names) != 1: continue # a new column
+        col1 = tbl1.columns[possible_prev_names.pop()]
+      if col1[2:6] == col2[2:6]: continue
+      # the same expressions the backfill stores, see diff()
+      old = f'"{col1.name}"'
+      cast_stmt = f'CAST({old} as {col2.type})' if col2.type else old
+      stored = f'COALESCE({cast_stmt}, {col2.dflt_value})' if col2.dflt_value else cast_stmt
+      cols.append((col_name, col1.type, col2.type))
+      # compared under SQLite's affinity rules, so 1 to '1' is no change but '1.5' to 1 is
+      sums += [f'sum({old} IS NOT NULL AND {cast_stmt} IS NOT {old})',
+               f'sum({old} IS NULL AND {stored} IS NOT NULL)',
+               f'sum({stored} IS NULL)' if col2.notnull else '0']
+    if not cols: continue
+    rows, *counts = db.execute(f'SELECT count(*), {", ".join(sums)} FROM "{tbl1.name}"').fetchone()
+    for i, (col_name, from_type, to_type) in enumerate(cols):
+      checks.append(ColumnCheck(tbl_name, col_name, from_type, to_type, rows, *(n or 0 for n in counts[3*i:3*i+3])))
+  return checks
+
+def _format_check(check):
+  return f'{check.tbl_name}.{check.col_name} ({check.from_type or "untyped"} -> {check.to_type or "untyped"}): {check.changed:,} of {check.rows:,} rows change value, {check.defaulted:,} NULLs defaulted, {check.not_null:,} NULLs violate NOT NULL'
+
+def _clone_sample(existing_db, db, sample):
+  '''
+  Copies existing_db's schema into db plus, per table, the first `sample` rows and `sample` random
+  rows by rowid (and the rows those reference through FKs), so a dry run can hit CAST, NOT NULL and
+  FK failures without copying the whole database.  A sample of 0 copies the schema only.
+  '''
+  db.execute('ATTACH DATABASE ? AS src', (existing_db,))
+  rows = db.execute("select type, name, sql from src.sqlite_schema where sql is not null and name not like 'sqlite_%' order by rowid").fetchall()
+  for type_, name, sql in rows:
+    if type_=='table':
+      db.execute(sql)
+  if sample:
+    rng = random.Random()
+    for type_, tbl_name, sql in rows:
+      if type_!='table': continue
+      try:
+        lo, hi = db.execute(f'select min(rowid), max(rowid) from src."{tbl_name}"').fetchone()
+      except sqlite3.OperationalError:
+        # WITHOUT ROWID table
+        _copy_rows(db, tbl_name, f'1 limit {int(sample)}')
+        continue
+      if lo is None: continue
+      rowids = {row[0] for row in db.execute(f'select rowid from src."{tbl_name}" order by rowid limit ?', (sample,))}
+      for _ in range(sample):
+        rowids.add(db.execute(f'select rowid from src."{tbl_name}" where rowid >= ? order by rowid limit 1', (rng.randint(lo, hi),)).fetchone()[0])
+      _copy_rows(db, tbl_name, 'rowid in (%s)' % ','.join(str(rowid) for rowid in sorted(rowids)))
+    for tbl_name, to_tbl, from_cols, to_cols in db.execute('''
+      select s.name, fk."table", group_concat(fk."from"), group_concat(fk."to")
+      from src.sqlite_schema s join pragma_foreign_key_list(s.name, 'src') fk
+      where s.type='table'
+      group by s.name, fk.id
+    ''').fetchall():
+      if to_cols is None: continue # references the parent's primary key implicitly
+      from_cols = ','.join([f'"{col_name}"' for col_name in from_cols.split(',')])
+      to_cols = ','.join([f'"{col_name}"' for col_name in to_cols.split(',')])
+      _copy_rows(db, to_tbl, f'({to_cols}) in (select {from_cols} from main."{tbl_name}")')
+  for type_, name, sql in rows:
+    if type_!='table':
+      db.execute(sql)
+  db.commit()
+  db.execute('DETACH DATABASE src')
+
+def _copy_rows(db, tbl_name, where):
+  cols = ','.join([f'"{row[0]}"' for row in db.execute("select name from pragma_table_xinfo(?, 'src') where hidden=0", (tbl_name,))])
+  try:
+    db.execute(f'insert or ignore into main."{tbl_name}" (rowid,{cols}) select rowid,{cols} from src."{tbl_name}" where {where}')
+  except sqlite3.OperationalError:
+    # WITHOUT ROWID table
+    db.execute(f'insert or ignore into main."{tbl_name}" ({cols}) select {cols} from src."{tbl_name}" where {where}')
 
 def _get_views(db):
   rows = db.execute("select name,tbl_name,rootpage,sql from sqlite_schema where type='view';").fetchall()
   views = [View(*row) for row in rows]
   return {view.name:view for view in views}
 
+_NO_AKAS = frozenset()
+
 def _get_tables(db):
+  # the model of a large schema is mostly small strings: identifiers, types and defaults are interned
+  # (so every column of a type, and both sides of a diff, share one copy), col_defs are kept as plain
+  # strs without their parse-time attributes, and AKA and FK sets are frozen, the empty ones shared
+  intern = sys.intern
   rows = db.execute("select name,tbl_name,rootpage,sql from sqlite_schema where type='table';").fetchall()
-  tbls = [Table(*row, {}, set(), {}, set()) for row in rows]
-  for tbl in tbls:
+  tbls = {intern(row[0]):Table(intern(row[0]), intern(row[1]), row[2], row[3], {}, set(), {}, set(), {}, {}) for row in rows}
+
+  # introspect every table in a handful of set-based queries instead of a few queries per table
+  columns_by_tbl = collections.defaultdict(list)
+  for row in db.execute('''
+    select s.name, p.cid, p.name, p.type, p."notnull", p.dflt_value, p.pk
+    from sqlite_schema s join pragma_table_info(s.name) p
+    where s.type='table'
+    order by s.name, p.cid
+  ''').fetchall():
+    columns_by_tbl[row[0]].append(row[1:])
+
+  unique_constraints_by_tbl = collections.defaultdict(lambda: collections.defaultdict(list))
+  for tbl_name, constraint_name, col_name in db.execute('''
+    select s.name, il.name, ii.name
+    from sqlite_schema s join pragma_index_list(s.name) il join pragma_index_info(il.name) ii
+    where s.type='table' and il."unique"
+  ''').fetchall():
+    unique_constraints_by_tbl[tbl_name][constraint_name].append(col_name)
+
+  fks_by_tbl = collections.defaultdict(list)
+  for row in db.execute('''
+    select s.name, fk.id, fk."table", group_concat(fk."from"), group_concat(fk."to"), fk.on_update, fk.on_delete, fk.match
+    from sqlite_schema s join pragma_foreign_key_list(s.name) fk
+    where s.type='table'
+    group by s.name, fk.id
+  ''').fetchall():
+    fks_by_tbl[row[0]].append(row[1:])
+
+  # explicit (CREATE INDEX) indexes, the implicit ones of UNIQUE and PRIMARY KEY constraints come and go with their table
+  index_columns = collections.defaultdict(list)
+  for index_name, col_name in db.execute('''
+    select s.name, ii.name
+    from sqlite_schema s join pragma_index_info(s.name) ii
+    where s.type='index' and s.sql is not null
+    order by s.name, ii.seqno
+  ''').fetchall():
+    index_columns[index_name].append(col_name)
+
+  for tbl_name, type_, name, sql in db.execute("select tbl_name, type, name, sql from sqlite_schema where type in ('index','trigger') and sql is not null").fetchall():
+    if tbl_name not in tbls:
+      continue
+    if type_=='index':
+      # columns are None for expressions
+      unique = bool(_CREATE_INDEX_RE.match(sql).group(1))
+      tbls[tbl_name].indexes[name] = Index(name, tbl_name, tuple(index_columns[name]), unique, sql)
+    else:
+      tbls[tbl_name].triggers[name] = sql
+
+  for tbl in tbls.values():
     tbl_stmt, column_defs, tbl_constraints, tbl_options = _parse_create_table(tbl.sql)
     
     # find comments
@@ -176,42 +1052,208 @@ def _get_tables(db):
       comments_by_identifier[col.identifier] = col.comments
     
     # find table akas
+    tbl_akas = _NO_AKAS
     for comment in tbl_stmt.comments:
       if match := AKA_RE.search(comment):
-        tbl.akas.update([s.strip() for s in match.group(1).split(',')])
+        tbl_akas = frozenset([s.strip() for s in match.group(1).split(',')])
         break
     
     col_def_by_column_name = {col_def.identifier:col_def for col_def in column_defs}
       
-    for row in db.execute(f'select * from pragma_table_info("{tbl.name}");').fetchall():
-      # row: cid,name,type,notnull,dflt_value,pk
-      name = row[1]
+    for cid, name, type_, notnull, dflt_value, pk in columns_by_tbl[tbl.name]:
+      name = intern(name)
       col_def = col_def_by_column_name[name]
       akas = set()
       for comment in comments_by_identifier[name]:
         if match := AKA_RE.search(comment):
           akas.update([s.strip() for s in match.group(1).split(',')])
-      column = Column(*row, col_def, akas)
-      tbl.columns[column.name] = column
-
-    for row in db.execute(f'select name from pragma_index_list("{tbl.name}") where "unique";').fetchall():
-      constraint_name = row[0]
-      constraint_columns = tuple(sorted([row[0] for row in db.execute(f'select name from pragma_index_info("{constraint_name}")').fetchall()]))
-      tbl.unique_constraints[constraint_name] = constraint_columns
-
-    for row in db.execute(f'''
-      select id, "table", group_concat("from"), group_concat("to"), on_update, on_delete, match
-      from pragma_foreign_key_list("{tbl.name}")
-      group by id
-    ''').fetchall():
-      # id|from|table|to|on_update|on_delete|match
-      from_cols = tuple(row[2].split(','))
-      to_cols = tuple(row[3].split(','))
-      fk = ForeignKey(tbl.name, from_cols, row[1], to_cols, *row[4:])
-      tbl.fks.add(fk)
+      column = Column(cid, name, intern(type_), notnull, dflt_value if dflt_value is None else intern(dflt_value), pk, str(col_def), frozenset(akas) if akas else _NO_AKAS)
+      tbl.columns[name] = column
+
+    for constraint_name, constraint_columns in unique_constraints_by_tbl[tbl.name].items():
+      tbl.unique_constraints[constraint_name] = tuple(sorted(intern(col_name) for col_name in constraint_columns))
+
+    fks = set()
+    for row in fks_by_tbl[tbl.name]:
+      # id|table|from|to|on_update|on_delete|match
+      from_cols = tuple(intern(col_name) for col_name in row[2].split(','))
+      to_cols = tuple(intern(col_name) for col_name in row[3].split(','))
+      fks.add(ForeignKey(tbl.name, from_cols, intern(row[1]), to_cols, *[intern(s) for s in row[4:]]))
 
-  return {tbl.name:tbl for tbl in tbls}
+    tbls[tbl.name] = tbl._replace(akas=tbl_akas, fks=frozenset(fks))
+
+  return tbls
   
+def _count_rewrites(tbl1, tbl2, prev_col_names):
+  '''How many times the per-column ALTER sequence would rewrite every row of the table.'''
+  added_cols = tbl2.columns.keys() - tbl1.columns.keys() - prev_col_names.keys()
+  drops = len(tbl1.columns.keys() - tbl2.columns.keys() - set(prev_col_names.values()))
+  backfilled_cols = 0
+  for col_name, col2 in tbl2.columns.items():
+    col1 = tbl1.columns.get(prev_col_names.get(col_name, col_name))
+    if col1 and col1[2:6] != col2[2:6]:
+      backfilled_cols += 1
+  for fk in tbl1.fks - tbl2.fks:
+    backfilled_cols += len(fk.from_cols)
+  for fk in tbl2.fks - tbl1.fks:
+    # multi-column FKs can't be added column by column, see diff()
+    if len(fk.from_cols) == 1 and not set(fk.from_cols) & added_cols:
+      backfilled_cols += 1
+  # one shared backfill UPDATE, plus a DROP COLUMN for each backfilled column's temp copy
+  return drops + backfilled_cols + (1 if backfilled_cols else 0)
+
+_WITHOUT_ROWID_RE = re.compile(r'\bwithout\s+rowid\s*;?\s*$', re.IGNORECASE)
+
+def _rewritten_columns(tbl1, tbl2, prev_col_names):
+  '''The columns of tbl1 whose data the per-column ALTER sequence moves to a new column (type or FK changes).'''
+  cols = set()
+  for col_name, col2 in tbl2.columns.items():
+    col1 = tbl1.columns.get(prev_col_names.get(col_name, col_name))
+    if col1 is not None and col1[2:6] != col2[2:6]:
+      cols.add(col1.name)
+  for fk in tbl1.fks ^ tbl2.fks:
+    cols.update(prev_col_names.get(col_name, col_name) for col_name in fk.from_cols)
+  return cols
+
+def _rebuild_table(tbl1, tbl2, prev_col_names, online=False, plan_renames=None):
+  '''
+  The "12-step" generalized ALTER TABLE procedure from https://www.sqlite.org/lang_altertable.html,
+  run after any column renames: create the target table under a temp name, copy every row once
+  (with CASTs for changed columns), swap it in, then recreate the surviving indexes and triggers.
+  Triggers can refer to other tables, so the table and column renames planned before this one
+  (plan_renames) are applied to them too, as SQLite did to the originals.
+  Online, the copy keeps rowids and triggers on the old table mirror every write into the new one,
+  so the (batched) copy can run alongside other writers.  The target's indexes are built on the new
+  table up front, so the swap, the only step holding the write lock for long, just moves the old
+  table aside (its rows are deleted in batches afterwards) and renames the new one into place.
+  '''
+  tbl_name = tbl2.name
+  tbl_hash = hashlib.md5(f'"{tbl_name}"'.encode()).hexdigest()[:6]
+  tmp_tbl_name = f'__tmp_tbl_{tbl_hash}__'
+  renames = {old_col_name:col_name for col_name, old_col_name in prev_col_names.items()}
+  dropped_cols = tbl1.columns.keys() - tbl2.columns.keys() - renames.keys()
+  online = online and not _WITHOUT_ROWID_RE.search(tbl1.sql) and not _WITHOUT_ROWID_RE.search(tbl2.sql)
+
+  cmds = ['PRAGMA foreign_keys=off', _rename_create_table(tbl2.sql, tmp_tbl_name)]
+  unique_constraints = {name:cols for name, cols in tbl2.unique_constraints.items() if name not in tbl2.indexes}
+  indexes = {}
+  if online:
+    # SQLite can't rename an index, and the old table's keep their names until it's dropped
+    taken = {name.lower() for name in tbl1.indexes}
+    for name, index in sorted(tbl2.indexes.items()):
+      shadow_name = _shadow_index_name(name, taken)
+      cmds.append(_rename_index(index.sql, shadow_name, tmp_tbl_name))
+      indexes[shadow_name] = index._replace(name=shadow_name, sql=_rename_index(index.sql, shadow_name, tbl_name))
+      if index.unique:
+        unique_constraints[shadow_name] = tbl2.unique_constraints[name]
+  to_cols, exprs = ['rowid'] if online else [], ['{}rowid'] if online else []
+  for col_name, col2 in tbl2.columns.items():
+    col1 = tbl1.columns.get(prev_col_names.get(col_name, col_name))
+    if col1 is None: continue # new column, gets its default
+    to_cols.append(f'"{col_name}"')
+    if col1[2:6] == col2[2:6] or not col2.type:
+      exprs.append(f'{{}}"{col_name}"')
+    else:
+      cast_stmt = f'CAST({{}}"{col_name}" as {col2.type})'
+      exprs.append(f'COALESCE({cast_stmt}, {col2.dflt_value})' if col2.dflt_value else cast_stmt)
+  insert = f'INSERT INTO "{tmp_tbl_name}" ({",".join(to_cols)})'
+  if online:
+    # keep the copy in sync with concurrent writes, rows not copied yet are (re)copied by their batch
+    values = ', '.join([expr.format('NEW.') for expr in exprs])
+    sync_triggers = [f'__tmp_trg_{tbl_hash}_{op}__' for op in ('insert', 'update', 'delete')]
+    cmds.append(f'CREATE TRIGGER "{sync_triggers[0]}" AFTER INSERT ON "{tbl_name}" BEGIN {insert} VALUES ({values}); END')
+    cmds.append(f'CREATE TRIGGER "{sync_triggers[1]}" AFTER UPDATE ON "{tbl_name}" BEGIN DELETE FROM "{tmp_tbl_name}" WHERE rowid = OLD.rowid; {insert} VALUES ({values}); END')
+    cmds.append(f'CREATE TRIGGER "{sync_triggers[2]}" AFTER DELETE ON "{tbl_name}" BEGIN DELETE FROM "{tmp_tbl_name}" WHERE rowid = OLD.rowid; END')
+  cmds.append(f'{insert} SELECT {", ".join([expr.format("") for expr in exprs])} FROM "{tbl_name}"')
+  # legacy mode keeps the renames from re-validating (or, for the old table, rewriting) views, triggers and FKs that point at the table
+  if online:
+    old_tbl_name = f'__old_tbl_{tbl_hash}__'
+    cmds.append('BEGIN IMMEDIATE')
+    # the old table's triggers must not fire while it's emptied
+    cmds += [f'DROP TRIGGER "{name}"' for name in sync_triggers + sorted(tbl1.triggers)]
+    cmds.append('PRAGMA legacy_alter_table=on')
+    cmds.append(f'ALTER TABLE "{tbl_name}" RENAME TO "{old_tbl_name}"')
+  else:
+    cmds.append(f'DROP TABLE "{tbl_name}"')
+    cmds.append('PRAGMA legacy_alter_table=on')
+  cmds.append(f'ALTER TABLE "{tmp_tbl_name}" RENAME TO "{tbl_name}"')
+  cmds.append('PRAGMA legacy_alter_table=off')
+
+  # constraints declared in the table def come back with it, explicit indexes (those still wanted, unless
+  # already built online) and triggers have to be recreated
+  wanted_unique_constraints = set(tbl2.unique_constraints.values())
+  wanted_index_defs = {_index_definition(index.sql) for index in tbl2.indexes.values() if not index.unique}
+  sql_renames = {tbl1.name:tbl_name, **renames} if tbl1.name!=tbl_name else renames
+  # other tables' column renames, unless they'd clash with this table's own columns
+  own_col_names = {col_name.lower() for col_name in tbl1.columns}
+  trigger_renames = {**{old:new for old, new in (plan_renames or {}).items() if old.lower() not in own_col_names}, **sql_renames}
+  for name, sql in [(name, index.sql) for name, index in tbl1.indexes.items() if not online] + list(tbl1.triggers.items()):
+    if _references_any(_rename_identifiers(sql, renames), dropped_cols):
+      continue
+    if name in tbl1.unique_constraints:
+      constraint_columns = tuple(sorted(renames.get(col_name, col_name) for col_name in tbl1.unique_constraints[name]))
+      if constraint_columns not in wanted_unique_constraints or constraint_columns in unique_constraints.values():
+        continue
+      unique_constraints[name] = constraint_columns
+    elif name in tbl1.indexes and _index_definition(sql, renames) not in wanted_index_defs:
+      continue
+    if name in tbl1.indexes:
+      indexes[name] = tbl1.indexes[name]
+    cmds.append(_rename_identifiers(sql, sql_renames if name in tbl1.indexes else trigger_renames))
+  if online:
+    cmds += ['COMMIT', f'DELETE FROM "{old_tbl_name}"', f'DROP TABLE "{old_tbl_name}"']
+  cmds.append('PRAGMA foreign_keys=on')
+  return cmds, unique_constraints, indexes
+
+_CREATE_TABLE_NAME_RE = re.compile(r'''^(\s*create\s+table\s+(?:if\s+not\s+exists\s+)?)("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s(]+)''', re.IGNORECASE)
+_IDENTIFIER_RE = re.compile(r'''"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|'(?:[^']|'')*'|[A-Za-z_][A-Za-z0-9_$]*''')
+
+_CREATE_INDEX_RE = re.compile(r'''^\s*create\s+(unique\s+)?index\s+(?:if\s+not\s+exists\s+)?(?:"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s(]+)\s+on\s+(?:"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s(]+)''', re.IGNORECASE)
+_DEFINITION_TOKEN_RE = re.compile(r'''"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|'(?:[^']|'')*'|[A-Za-z_][A-Za-z0-9_$]*|\S''')
+
+def _index_definition(sql, renames=None):
+  '''
+  What an index covers, comparable however it's spelled: whether it's unique, plus its column list
+  (with expressions, collations and sort orders) and WHERE clause as tokens without quotes, case
+  or whitespace.  renames maps old to new column names.
+  '''
+  renames = {k.lower():v.lower() for k,v in (renames or {}).items()}
+  m = _CREATE_INDEX_RE.match(sql)
+  tokens = ['unique' if m.group(1) else 'index']
+  for tok in _DEFINITION_TOKEN_RE.findall(sql, m.end()):
+    tok = tok if tok.startswith("'") else _unquote_identifier(tok).lower()
+    tokens.append(renames.get(tok, tok))
+  return ' '.join(tokens)
+
+_INDEX_NAMES_RE = re.compile(r'''^(\s*create\s+(?:unique\s+)?index\s+(?:if\s+not\s+exists\s+)?)("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s(]+)(\s+on\s+)("(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\]|[^\s(]+)''', re.IGNORECASE)
+
+def _rename_index(sql, name, tbl_name):
+  return _INDEX_NAMES_RE.sub(lambda m: f'{m.group(1)}"{name}"{m.group(3)}"{tbl_name}"', sql, count=1)
+
+def _shadow_index_name(name, taken):
+  # alternates between name and name__online over repeated online rebuilds
+  base = name[:-len('__online')] if name.endswith('__online') else name
+  for candidate in itertools.chain([base, base+'__online'], (f'{base}__online{i}' for i in itertools.count(2))):
+    if candidate.lower() not in taken:
+      return candidate
+
+def _rename_create_table(sql, tbl_name):
+  return _CREATE_TABLE_NAME_RE.sub(lambda m: f'{m.group(1)}"{tbl_name}"', sql, count=1)
+
+def _rename_identifiers(sql, renames):
+  if not renames: return sql
+  renames = {k.lower():v for k,v in renames.items()}
+  def f(m):
+    tok = m.group()
+    if tok.startswith("'"): return tok
+    new_name = renames.get(_unquote_identifier(tok).lower())
+    return f'"{new_name}"' if new_name else tok
+  return _IDENTIFIER_RE.sub(f, sql)
+
+def _references_any(sql, identifiers):
+  identifiers = {s.lower() for s in identifiers}
+  return any(_unquote_identifier(tok).lower() in identifiers for tok in _IDENTIFIER_RE.findall(sql) if not tok.startswith("'"))
+
 def _add_column(tbl_name, column):
   cmds = []
   if column.notnull and not column.dflt_value:
@@ -223,23 +1265,54 @@ def _add_column(tbl_name, column):
   return cmds
 
 
-def schema_evolve(existing_db, schema_sql, dry_run:bool=True, skip_dry_run:bool=False, apply:bool=False, assume_yes:bool=False, quiet:bool=False):
+def schema_evolve(existing_db, schema_sql, dry_run:bool=True, skip_dry_run:bool=False, apply:bool=False, assume_yes:bool=False, quiet:bool=False, no_cache:bool=False, batch_size:int=0, checkpoint:str='PASSIVE', sample:int=None, memory_limit:int=None, online:bool=False, busy_timeout:int=BUSY_TIMEOUT, lock_budget:int=None, metrics:str=None, max_seconds:float=None, force:bool=False, dbstat:bool=False, no_preflight:bool=False):
   '''Schema Diff Tool'''
-  
+
+  # metrics: a JSON lines file to append to, or (from python) a callback taking StatementMetrics
+  if isinstance(metrics, str):
+    metrics = jsonl_metrics(metrics)
   if not quiet:
     print('Existing Database:', existing_db, '(to modify)')
     print('Target Schema:', schema_sql)
-  changes = diff(existing_db, schema_sql)
+  # a plan that will be applied is made from the database as it is now, never from a cached snapshot
+  changes = diff(existing_db, schema_sql, cache=not (no_cache or apply), online=online)
   if not changes:
     if not quiet: print('No changes.')
     return
+  # online rebuilds only let other writers in between batches
+  batch_size = batch_size or (ONLINE_BATCH_SIZE if online else 0)
+  # refuse plans estimated to take longer than max_seconds, or to need more disk than is free, unless forced
+  estimate_db = _open(existing_db)
+  costs = estimate(estimate_db, changes, dbstat=dbstat)
+  # one scan per retyped table tells what the conversions do to the data, before anything is copied
+  checks = preflight(estimate_db, _load(schema_sql, cache=not no_cache)[0]) if not no_preflight else []
+  estimate_db.close()
+  seconds = sum(cost.seconds for cost in costs)
+  disk = sum(cost.disk for cost in costs)
+  free = shutil.disk_usage(os.path.dirname(os.path.abspath(existing_db))).free
   if not quiet:
     print('Calculated Changes:')
-    for change in changes:
-      print(' ', change+';')
+    for change, cost in zip(changes, costs):
+      print(' ', change+';'+_format_cost(cost))
+    if changes.statements_saved:
+      print(f'Optimized: {changes.statements_saved} redundant statements removed ({changes.rewrites_saved} table rewrites)')
+    print(f'Estimated Cost: ~{seconds:.1f}s, {disk/1e6:.1f}MB of disk headroom ({free/1e6:.1f}MB free)')
+    if checks:
+      print('Pre-flight Check:')
+      for check in checks:
+        print(' ', _format_check(check))
+  if not force:
+    for check in checks:
+      if check.not_null:
+        raise RuntimeError(f'{check.not_null:,} rows of {check.tbl_name}.{check.col_name} would be NULL in a NOT NULL column (use --force to run it anyway)')
+    if max_seconds is not None and seconds > max_seconds:
+      raise RuntimeError(f'plan estimated to take ~{seconds:.3g}s, over max_seconds={max_seconds} (use --force to run it anyway)')
+    if disk > free:
+      raise RuntimeError(f'plan estimated to need {disk/1e6:.1f}MB of disk, only {free/1e6:.1f}MB free (use --force to run it anyway)')
+  echo = None if quiet else lambda change: print(' ', change+';')
   
   if dry_run and not skip_dry_run:
-    tmp_db = os.path.join(tempfile.mkdtemp(), 'test.db')
+    tmp_db = _dry_run_db(existing_db, sample=sample, memory_limit=memory_limit)
     if not assume_yes:
       while True:
         v = input('Apply changes (dry run @ %s)? (y/n) ' % tmp_db)
@@ -247,15 +1320,9 @@ def schema_evolve(existing_db, schema_sql, dry_run:bool=True, skip_dry_run:bool=
         if v=='y': break
     if not quiet:
       print('Starting Test Run:', tmp_db)
-    shutil.copyfile(existing_db, tmp_db)
-    with sqlite3.connect(tmp_db) as db:
-      for change in changes:
-        if not quiet:
-          print(' ', change+';')
-        db.execute(change)
+    _dry_run(existing_db, tmp_db, changes, sample=sample, batch_size=batch_size, checkpoint=checkpoint, echo=echo, metrics=metrics)
     if not quiet:
       print('Successful dry run!')
-    os.remove(tmp_db)
 
   if apply:
     if not assume_yes:
@@ -270,15 +1337,222 @@ def schema_evolve(existing_db, schema_sql, dry_run:bool=True, skip_dry_run:bool=
         print(i, end='... ', flush=True)
         time.sleep(1)
       print()
-    with sqlite3.connect(existing_db) as db:
-      for change in changes:
-        if not quiet:
-          print(' ', change+';')
-        db.execute(change)
+    db = sqlite3.connect(existing_db, timeout=busy_timeout/1000)
+    stats = _apply(db, changes, batch_size=batch_size, checkpoint=checkpoint, echo=echo, lock_budget=lock_budget, metrics=metrics)
+    db.close()
     if not quiet:
       print('Success!')
+      print(f'Write lock held: {stats.held:.3f}s in {stats.transactions} transactions (other writers blocked for at most {stats.max_held:.3f}s at a time)')
+      print(f'Waited for other writers: {stats.waited:.3f}s ({stats.retries} retries)')
+      if stats.over_budget:
+        print(f'Lock budget ({lock_budget}ms) exceeded by {stats.over_budget} transactions')
         
 
+Progress = collections.namedtuple('Progress', 'stage,statement')
+
+_executor = None
+
+def _get_executor():
+  # a pool of our own, so long migrations don't starve the loop's default executor
+  global _executor
+  if _executor is None:
+    import concurrent.futures
+    _executor = concurrent.futures.ThreadPoolExecutor(thread_name_prefix='schema_evolve')
+  return _executor
+
+async def diff_async(fn1, fn2, executor=None, **kwargs):
+  '''diff() run off the event loop, on executor (default: a thread pool dedicated to schema_evolve).'''
+  import asyncio, functools
+  loop = asyncio.get_running_loop()
+  return await loop.run_in_executor(executor or _get_executor(), functools.partial(diff, fn1, fn2, **kwargs))
+
+async def schema_evolve_async(existing_db, schema_sql, dry_run=True, apply=False, cache=True, batch_size=0, checkpoint='PASSIVE', sample=None, memory_limit=None, online=False, busy_timeout=BUSY_TIMEOUT, lock_budget=None, metrics=None, executor=None):
+  '''
+  Non-interactive schema_evolve() for asyncio services: the SQLite work runs on executor while
+  this async iterator yields a Progress(stage, statement) before each statement runs, stage being
+  'plan', 'dry_run' or 'apply'.  A statement only runs once the consumer asks for the next
+  Progress, so cancelling the consuming task (or aclose()) stops the migration right there and
+  its transaction rolls back.  Errors are raised from the iterator.  metrics is as for
+  schema_evolve(), a callback is called on the executor's thread.
+  '''
+  import asyncio
+  loop = asyncio.get_running_loop()
+  queue = asyncio.Queue()
+  resumed = threading.Semaphore(0)
+  cancelled = threading.Event()
+
+  def emit(stage, statement):
+    loop.call_soon_threadsafe(queue.put_nowait, Progress(stage, statement))
+    resumed.acquire()
+    if cancelled.is_set():
+      raise RuntimeError('migration of %s cancelled' % existing_db)
+
+  batch_size = batch_size or (ONLINE_BATCH_SIZE if online else 0)
+  if isinstance(metrics, str):
+    metrics = jsonl_metrics(metrics)
+
+  def run():
+    changes = diff(existing_db, schema_sql, cache=cache and not apply, online=online)
+    for change in changes:
+      emit('plan', change)
+    if changes and dry_run:
+      tmp_db = _dry_run_db(existing_db, sample=sample, memory_limit=memory_limit)
+      _dry_run(existing_db, tmp_db, changes, sample=sample, batch_size=batch_size, checkpoint=checkpoint, echo=lambda cmd: emit('dry_run', cmd), metrics=metrics)
+    if changes and apply:
+      db = sqlite3.connect(existing_db, timeout=busy_timeout/1000)
+      try:
+        _apply(db, changes, batch_size=batch_size, checkpoint=checkpoint, echo=lambda cmd: emit('apply', cmd), lock_budget=lock_budget, metrics=metrics)
+      finally:
+        db.close()
+
+  future = loop.run_in_executor(executor or _get_executor(), run)
+  # queued behind every Progress the worker scheduled before it finished
+  future.add_done_callback(lambda _: queue.put_nowait(None))
+  try:
+    while (progress := await queue.get()) is not None:
+      yield progress
+      resumed.release()
+    await future
+  finally:
+    cancelled.set()
+    resumed.release()
+    if not future.done():
+      # let the worker roll back before handing control back
+      await asyncio.wait([future])
+    if not future.cancelled():
+      future.exception()
+
+def _dry_run_db(existing_db, sample=None, memory_limit=None):
+  memory_limit = MEMORY_DRY_RUN_LIMIT if memory_limit is None else memory_limit
+  in_memory = sample is not None or os.path.getsize(existing_db) <= memory_limit
+  return ':memory:' if in_memory else os.path.join(tempfile.mkdtemp(), 'test.db')
+
+def _dry_run(existing_db, tmp_db, changes, sample=None, batch_size=0, checkpoint='PASSIVE', echo=None, metrics=None):
+  if tmp_db != ':memory:':
+    shutil.copyfile(existing_db, tmp_db)
+  db = sqlite3.connect(tmp_db)
+  try:
+    if sample is not None:
+      _clone_sample(existing_db, db, sample)
+    elif tmp_db == ':memory:':
+      # the backup API also picks up anything still in the source's WAL
+      with sqlite3.connect(existing_db) as src:
+        src.backup(db)
+      src.close()
+    _apply(db, changes, batch_size=batch_size, checkpoint=checkpoint, echo=echo, metrics=metrics, stage='dry_run')
+  finally:
+    db.close()
+    if tmp_db != ':memory:':
+      os.remove(tmp_db)
+
+
+FleetResult = collections.namedtuple('FleetResult', 'db,status,changes,error,seconds,schema_hash')
+
+def fleet_evolve(schema_sql, *existing_dbs, dry_run:bool=True, skip_dry_run:bool=False, apply:bool=False, workers:int=0, quiet:bool=False, no_cache:bool=False, no_group:bool=False, batch_size:int=0, checkpoint:str='PASSIVE', sample:int=None, memory_limit:int=None, online:bool=False, busy_timeout:int=BUSY_TIMEOUT, lock_budget:int=None, metrics:str=None):
+  '''Schema Diff Tool (fleet mode: every database matching the given paths/globs, in parallel)'''
+  fns = sorted({fn for pattern in existing_dbs for fn in (glob.glob(pattern) or [pattern])})
+  # parse the target once, every worker gets its own copy of the model up front
+  target = _load(schema_sql, cache=not no_cache)
+  batch_size = batch_size or (ONLINE_BATCH_SIZE if online else 0)
+  opts = dict(dry_run=dry_run and not skip_dry_run, apply=apply, cache=not (no_cache or apply), batch_size=batch_size, checkpoint=checkpoint, sample=sample, memory_limit=memory_limit, online=online, busy_timeout=busy_timeout, lock_budget=lock_budget, metrics=metrics)
+  workers = workers or os.cpu_count() or 1
+  if memory_limit is None:
+    # every worker may hold a database in RAM at once
+    opts['memory_limit'] = MEMORY_DRY_RUN_LIMIT // min(workers, len(fns) or 1)
+  if not quiet:
+    print('Target Schema:', schema_sql)
+    print('Databases:', len(fns), '(workers: %i)' % min(workers, len(fns) or 1))
+
+  # most databases in a fleet share a schema, so plan once per distinct sqlite_schema
+  schema_hashes, plans = {}, {}
+  for fn in ([] if no_group else fns):
+    try:
+      schema_hash = schema_hashes[fn] = _schema_hash(fn)
+      if schema_hash is not None and schema_hash not in plans:
+        plans[schema_hash] = _diff(*_load(fn, cache=opts['cache']), *target, online=online)
+    except Exception:
+      # leave it to the worker to fail (or not) on its own
+      pass
+  if not quiet and not no_group:
+    print('Distinct Schemas:', len(plans))
+
+  results = []
+  def done(result):
+    results.append(result)
+    if not quiet:
+      print(' ', result.status.ljust(9), result.db, result.error or '%i changes' % len(result.changes or []))
+  if workers == 1:
+    _fleet_init(target, plans)
+    for fn in fns:
+      done(_fleet_evolve_db(fn, schema_hashes.get(fn), opts))
+  else:
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, initializer=_fleet_init, initargs=(target, plans)) as pool:
+      futures = {pool.submit(_fleet_evolve_db, fn, schema_hashes.get(fn), opts):fn for fn in fns}
+      for future in concurrent.futures.as_completed(futures):
+        try:
+          done(future.result())
+        except Exception as e:
+          # the worker itself died (_fleet_evolve_db catches everything else)
+          fn = futures[future]
+          done(FleetResult(fn, 'failed', None, f'{type(e).__name__}: {e}', None, schema_hashes.get(fn)))
+
+  results.sort(key=lambda result: result.db)
+  if not quiet:
+    counts = collections.Counter(result.status for result in results)
+    print('Summary:', ', '.join(f'{n} {status}' for status, n in sorted(counts.items())))
+  return results
+
+_fleet_target = None
+_fleet_plans = {}
+
+def _fleet_init(target, plans):
+  global _fleet_target, _fleet_plans
+  _fleet_target = target
+  _fleet_plans = plans
+
+def _schema_hash(fn):
+  '''Hash of a database's sqlite_schema; databases with equal schema_hashes get identical diffs.'''
+  if not _is_sqlite_file(fn):
+    return None
+  import pathlib
+  db = sqlite3.connect(pathlib.Path(fn).resolve().as_uri()+'?mode=ro', uri=True)
+  try:
+    rows = db.execute('select type, name, tbl_name, sql from sqlite_schema order by type, name').fetchall()
+  finally:
+    db.close()
+  return hashlib.sha256(repr(rows).encode()).hexdigest()
+
+def _fleet_evolve_db(fn, schema_hash, opts):
+  start = time.perf_counter()
+  changes = None
+  try:
+    # re-check: the schema may have moved on since the plan was made
+    if schema_hash in _fleet_plans and _schema_hash(fn) == schema_hash:
+      changes = list(_fleet_plans[schema_hash])
+    else:
+      tbls1, views1 = _load(fn, cache=opts['cache'])
+      tbls2, views2 = _fleet_target
+      changes = _diff(tbls1, views1, tbls2, views2, online=opts['online'])
+    status = 'unchanged' if not changes else 'planned'
+    # the workers append to the same file, each line says which database it's about
+    metrics = jsonl_metrics(opts['metrics'], db=fn) if opts['metrics'] else None
+    if changes and opts['dry_run']:
+      tmp_db = _dry_run_db(fn, sample=opts['sample'], memory_limit=opts['memory_limit'])
+      _dry_run(fn, tmp_db, changes, sample=opts['sample'], batch_size=opts['batch_size'], checkpoint=opts['checkpoint'], metrics=metrics)
+      status = 'dry_run'
+    if changes and opts['apply']:
+      db = sqlite3.connect(fn, timeout=opts['busy_timeout']/1000)
+      try:
+        _apply(db, changes, batch_size=opts['batch_size'], checkpoint=opts['checkpoint'], lock_budget=opts['lock_budget'], metrics=metrics)
+      finally:
+        db.close()
+      status = 'applied'
+    return FleetResult(fn, status, changes, None, time.perf_counter()-start, schema_hash)
+  except Exception as e:
+    return FleetResult(fn, 'failed', changes, f'{type(e).__name__}: {e}', time.perf_counter()-start, schema_hash)
+
+
 class SQLPart(str):
   def __new__(cls, s):
     o = str.__new__(cls, s)
@@ -317,69 +1591,93 @@ def _parse_table_def(tbl_stmt, sql):
       column_defs.append(part)
   return column_defs, tbl_constraints
 
+_PART_TOKEN_RE = re.compile(r'''--[^\n]*\n?|/\*.*?(?:\*/|\Z)|"[^"]*(?:"|\Z)|'[^']*(?:'|\Z)|`[^`]*(?:`|\Z)|\[[^\]]*(?:\]|\Z)|[(),]|\s+''', re.DOTALL)
+
+def _unquote_identifier(s):
+  s = s.strip()
+  if len(s) >= 2 and s[0]+s[-1] in ('""', '``', '[]'):
+    s = s[1:-1]
+  return s
+
 def _parse_table_def_parts(sql):
-  stack = []
-  end = 0
-  i = -1
+  # single pass over the tokens that matter (comments, quoted strings/identifiers, parens, commas, whitespace);
+  # comments are cut out of each part by joining the slices around them, never by rebuilding sql
+  depth = 0
+  seg_start = 0
+  chunks = []
+  last_end = 0
+  ident_start = None
   part = None
   parts = []
   inner_comments = []
   identifier = None
   comments = []
-  while i < len(sql)-1:
-    i += 1
-    c = sql[i]
-    if c==',' and not stack:
-      part = SQLPart(sql[end:i].strip())
+  for m in _PART_TOKEN_RE.finditer(sql):
+    i = m.start()
+    if ident_start is None and i > last_end:
+      ident_start = last_end
+    last_end = m.end()
+    tok = m.group()
+    c = tok[0]
+    if c==',' and not depth:
+      if identifier is None and ident_start is not None:
+        identifier = _unquote_identifier(sql[ident_start:i])
+      chunks.append(sql[seg_start:i])
+      part = SQLPart(''.join(chunks).strip())
       part.comments += inner_comments + comments
       part.identifier = identifier
       identifier = None
+      ident_start = None
       inner_comments = []
       comments = []
+      chunks = []
       parts.append(part)
-      end = i+1
+      seg_start = m.end()
       continue
-    if c=='-':
-      if stack and stack[-1]=='-':
-        comment = sql[i-1:sql.index('\n',i)].strip()
-        if len(stack) > 1: inner_comments.append(comment[2:].strip())
-        elif identifier: comments.append(comment[2:].strip())
-        elif part: part.comments.append(comment[2:].strip())
-        else: parts.append(comment)
-        stack.pop()
-        sql = sql[:i-1] + sql[sql.index('\n',i)+1:]
-        continue
-      else:
-        stack.append(c)
+    if tok.startswith('--') or tok.startswith('/*'):
+      comment = (tok[2:-2] if tok.endswith('*/') else tok[2:]).strip()
+      if not depth and identifier is None and ident_start is not None:
+        identifier = _unquote_identifier(sql[ident_start:i])
+      if depth: inner_comments.append(comment)
+      elif identifier: comments.append(comment)
+      elif part: part.comments.append(comment)
+      else: parts.append('-- '+comment)
+      chunks.append(sql[seg_start:i])
+      seg_start = m.end()
       continue
-    if c=='(':
-      stack.append(c)
-      continue
-    if c==')' and stack[-1]=='(':
-      stack.pop()
-      continue
-    if c=='"':
-      if stack and stack[-1]=='"':
-        stack.pop()
-        continue
-      else:
-        stack.append(c)
-        continue
-    if c==' ' and not stack and not identifier:
-      identifier = sql[end:i].strip().strip('"').strip()
+    if c.isspace():
+      if not depth and identifier is None and ident_start is not None:
+        identifier = _unquote_identifier(sql[ident_start:i])
       continue
-  part = SQLPart(sql[end:].strip())
+    if ident_start is None:
+      ident_start = i
+    if c=='(':
+      depth += 1
+    elif c==')' and depth:
+      depth -= 1
+  if identifier is None:
+    if ident_start is None and len(sql) > last_end:
+      ident_start = last_end
+    if ident_start is not None:
+      identifier = _unquote_identifier(sql[ident_start:])
+  chunks.append(sql[seg_start:])
+  part = SQLPart(''.join(chunks).strip())
   part.identifier = identifier
   part.comments += inner_comments + comments
   parts.append(part)
-  return parts      
-      
-    
-  
+  return parts
+
 
 if __name__=='__main__':
+  import darp
   try:
-    darp.prep(schema_evolve).run()
+    if sys.argv[1:2]==['fleet']:
+      darp.prep(fleet_evolve).run(sys.argv[1:])
+    elif sys.argv[1:2]==['fingerprint']:
+      for fn in sys.argv[2:]:
+        print(fingerprint(fn), fn)
+    else:
+      darp.prep(schema_evolve).run()
   except KeyboardInterrupt:
     print(' [Aborted]')
 
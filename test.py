@@ -1,5 +1,11 @@
-import pytest, sqlite3
-from schema_evolve import diff, _parse_create_table
+import asyncio, io, json, os, pytest, shutil, sqlite3, threading
+import schema_evolve
+from schema_evolve import diff, _parse_create_table, _get_tables, ForeignKey
+
+@pytest.fixture(autouse=True)
+def cache_dir(tmp_path, monkeypatch):
+  # keep the snapshot cache out of the real ~/.cache
+  monkeypatch.setattr(schema_evolve, 'CACHE_DIR', str(tmp_path / 'cache'))
 
 
 def test_add_table():
@@ -141,6 +147,22 @@ def test_rename_column():
     'ALTER TABLE "tbl" RENAME COLUMN "a" TO "b"'
   ]
 
+def test_rename_and_retype_column():
+  assert diff(
+    'create table tbl (a text)',
+    '''
+      create table tbl (
+        b int -- AKA[a]
+      )
+    ''',
+    apply=True
+  ) == [
+    'ALTER TABLE "tbl" RENAME COLUMN "a" TO __tmp_col_8d901e__',
+    'ALTER TABLE "tbl" ADD COLUMN b int',
+    'UPDATE "tbl" SET "b" = CAST(__tmp_col_8d901e__ as INT)',
+    'ALTER TABLE "tbl" DROP COLUMN __tmp_col_8d901e__',
+  ]
+
 def test_rename_two_columns():
   assert diff(
     'create table tbl (a text, b text)',
@@ -669,3 +691,831 @@ def test_read_files():
   ) == []
 
 
+
+def test_get_tables_many():
+  db = sqlite3.connect(':memory:')
+  db.executescript('''
+    create table a (id int primary key, x text unique, y text, unique(x,y));
+    create table b (id int primary key, a_id int references a(id), z text);
+    create table c (w text);
+  ''')
+  tbls = _get_tables(db)
+  assert list(tbls) == ['a','b','c']
+  assert list(tbls['a'].columns) == ['id','x','y']
+  assert list(tbls['b'].columns) == ['id','a_id','z']
+  assert sorted(tbls['a'].unique_constraints.values()) == [('id',),('x',),('x','y')]
+  assert tbls['b'].unique_constraints == {'sqlite_autoindex_b_1':('id',)}
+  assert tbls['b'].fks == {ForeignKey('b', ('a_id',), 'a', ('id',), 'NO ACTION', 'NO ACTION', 'NONE')}
+  assert tbls['c'].unique_constraints == {} and tbls['c'].fks == set()
+
+def test_snapshot_cache(tmp_path, monkeypatch):
+  sql_fn = tmp_path / 'schema.sql'
+  sql_fn.write_text('create table tbl (a text, b text);\n')
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text)')
+  db.close()
+  assert diff(db_fn, str(sql_fn)) == ['ALTER TABLE "tbl" ADD COLUMN b text']
+  assert len(os.listdir(tmp_path / 'cache')) == 2
+
+  # warm run never opens either input
+  def _open(s, **kwargs): raise AssertionError('cache miss: '+s)
+  monkeypatch.setattr(schema_evolve, '_open', _open)
+  assert diff(db_fn, str(sql_fn)) == ['ALTER TABLE "tbl" ADD COLUMN b text']
+  with pytest.raises(AssertionError, match='cache miss'):
+    diff(db_fn, str(sql_fn), cache=False)
+  monkeypatch.undo()
+  monkeypatch.setattr(schema_evolve, 'CACHE_DIR', str(tmp_path / 'cache'))
+
+  # a schema change bumps schema_version and misses the cache
+  with sqlite3.connect(db_fn) as db:
+    db.execute('alter table tbl add column b text')
+  db.close()
+  assert diff(db_fn, str(sql_fn)) == []
+  assert len(os.listdir(tmp_path / 'cache')) == 3
+
+  # a database recreated at the same path (likely reusing the inode, with schema_version back at 1)
+  # is keyed on its schema, not on the first database's
+  os.remove(db_fn)
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text, b text)')
+  db.close()
+  assert diff(db_fn, str(sql_fn)) == [] == diff(db_fn, str(sql_fn), cache=False)
+  assert len(os.listdir(tmp_path / 'cache')) == 3
+
+  schema_evolve._cache_evict(1)
+  assert len(os.listdir(tmp_path / 'cache')) == 1
+  schema_evolve.clear_cache()
+  assert os.listdir(tmp_path / 'cache') == []
+
+def test_parse_create_table_quoting():
+  tbl_stmt, column_defs, tbl_constraints, tbl_options = _parse_create_table('''
+    create table tbl_name (
+      [my col] text default '--,(',
+      `other col` int default -1, -- aka[other]
+      "q(" text /* aka[q] */
+    )
+  ''')
+  assert column_defs == [
+    "[my col] text default '--,('",
+    '`other col` int default -1',
+    '"q(" text',
+  ]
+  assert [cd.identifier for cd in column_defs] == ['my col','other col','q(']
+  assert [cd.comments for cd in column_defs] == [[],['aka[other]'],['aka[q]']]
+
+def test_rename_bracket_quoted_column():
+  assert diff(
+    'create table tbl ([a b] text)',
+    '''
+      create table tbl (
+        [c d] text -- AKA[a b]
+      )
+    ''',
+    apply=True
+  ) == [
+    'ALTER TABLE "tbl" RENAME COLUMN "a b" TO "c d"'
+  ]
+
+def test_rebuild_table():
+  assert diff(
+    '''
+      create table tbl (a int, b int, c text, d text);
+      create index tbl_c on tbl(c);
+      create index tbl_d on tbl(d);
+      create view v as select a from tbl;
+      insert into tbl values (1, 2, '3', '4');
+    ''',
+    '''
+      create table tbl (a text, b text, cc text, -- AKA[c]
+        e text default 'x');
+      create index tbl_c on tbl(cc);
+      create view v as select a from tbl;
+    ''',
+    apply=True
+  ) == [
+    'ALTER TABLE "tbl" RENAME COLUMN "c" TO "cc"',
+    'PRAGMA foreign_keys=off',
+    '''CREATE TABLE "__tmp_tbl_c619e1__" (a text, b text, cc text, -- AKA[c]
+        e text default 'x')''',
+    'INSERT INTO "__tmp_tbl_c619e1__" ("a","b","cc") SELECT CAST("a" as TEXT), CAST("b" as TEXT), "cc" FROM "tbl"',
+    'DROP TABLE "tbl"',
+    'PRAGMA legacy_alter_table=on',
+    'ALTER TABLE "__tmp_tbl_c619e1__" RENAME TO "tbl"',
+    'PRAGMA legacy_alter_table=off',
+    'CREATE INDEX tbl_c on tbl("cc")',
+    'PRAGMA foreign_keys=on',
+  ]
+
+def test_rebuild_table_data():
+  db = sqlite3.connect(':memory:')
+  db.executescript('''
+    create table tbl (id int primary key, a int, b int unique, c text);
+    create unique index tbl_c on tbl(c);
+    insert into tbl values (1, 2, 3, 'x');
+  ''')
+  target = 'create table tbl (id int primary key, a text, b text unique, c text)'
+  for cmd in diff('create table tbl (id int primary key, a int, b int unique, c text); create unique index tbl_c on tbl(c);', target):
+    db.execute(cmd)
+  assert db.execute('select id, a, b, c, typeof(a), typeof(b) from tbl').fetchall() == [(1, '2', '3', 'x', 'text', 'text')]
+  assert sorted(_get_tables(db)['tbl'].unique_constraints.values()) == [('b',),('id',)]
+
+def test_rebuild_trigger_follows_renames(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.executescript('''
+      create table p (id int primary key, cnt int default 0);
+      create table ch (id int primary key, p_id int, x text);
+      create trigger ch_count after insert on ch begin update p set cnt = cnt + 1 where id = NEW.p_id; end;
+      insert into p (id) values (1);
+    ''')
+  db.close()
+  # the trigger on the rebuilt table comes back pointing at the renamed table and column,
+  # whichever of the two tables the plan gets to first
+  target = '''
+    create table q ( -- AKA[p]
+      id int primary key,
+      n int default 0 -- AKA[cnt]
+    );
+    create table ch (id int primary key, p_id int, x int);
+  '''
+  changes = diff(db_fn, target, cache=False, rebuild=True)
+  assert 'ALTER TABLE "p" RENAME TO "q"' in changes and any(c.startswith('INSERT INTO "__tmp_tbl_') for c in changes)
+  db = sqlite3.connect(db_fn)
+  schema_evolve._apply(db, changes)
+  db.execute('insert into ch values (1, 1, 2)')
+  assert db.execute('select id, n from q').fetchall() == [(1, 1)]
+  db.close()
+
+def test_rebuild_forced():
+  assert diff('create table tbl (a int)', 'create table tbl (a text)', rebuild=True)[1:3] == [
+    'CREATE TABLE "__tmp_tbl_c619e1__" (a text)',
+    'INSERT INTO "__tmp_tbl_c619e1__" ("a") SELECT CAST("a" as TEXT) FROM "tbl"',
+  ]
+  assert not any('__tmp_tbl' in cmd for cmd in diff('create table tbl (a int, b int)', 'create table tbl (a text, b text)', rebuild=False))
+
+def test_change_column_defs_single_backfill():
+  assert diff(
+    '''
+      create table a (id int primary key);
+      create table b (id int primary key, x int, y int, a_id int);
+      insert into a values (1);
+      insert into b values (1, 2, 3, 1);
+    ''',
+    '''
+      create table a (id int primary key);
+      create table b (id int primary key, x text, y text default 'n/a', a_id int references a(id));
+    ''',
+    apply=True,
+    rebuild=False
+  ) == [
+    'ALTER TABLE "b" RENAME COLUMN "x" TO __tmp_col_43f885__',
+    'ALTER TABLE "b" ADD COLUMN x text',
+    'ALTER TABLE "b" RENAME COLUMN "y" TO __tmp_col_894dfe__',
+    'ALTER TABLE "b" ADD COLUMN y text default \'n/a\'',
+    'PRAGMA foreign_keys=off',
+    'ALTER TABLE "b" RENAME COLUMN "a_id" TO __tmp_col_7f0cc3__',
+    'ALTER TABLE "b" ADD COLUMN a_id int references a(id)',
+    'UPDATE "b" SET "x" = CAST(__tmp_col_43f885__ as TEXT), "y" = COALESCE(CAST(__tmp_col_894dfe__ as TEXT), \'n/a\'), "a_id" = "__tmp_col_7f0cc3__"',
+    'ALTER TABLE "b" DROP COLUMN __tmp_col_43f885__',
+    'ALTER TABLE "b" DROP COLUMN __tmp_col_894dfe__',
+    'ALTER TABLE "b" DROP COLUMN __tmp_col_7f0cc3__',
+    'PRAGMA foreign_keys=on',
+  ]
+
+def test_batched_backfill(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  db = sqlite3.connect(db_fn)
+  db.execute('pragma journal_mode=wal')
+  db.execute('create table tbl (a int, b int, c int)')
+  db.executemany('insert into tbl values (?,?,?)', [(i, i, i) for i in range(10)])
+  db.execute('delete from tbl where a in (3,4,5)')
+  db.commit()
+  statements = []
+  db.set_trace_callback(statements.append)
+  for change in diff(db_fn, 'create table tbl (a text, b text, c int)', cache=False):
+    schema_evolve._execute(db, change, batch_size=3)
+  db.commit()
+  assert db.execute('select a, b, c from tbl').fetchall() == [(str(i), str(i), i) for i in range(10) if i not in (3,4,5)]
+  assert len([s for s in statements if s.startswith('INSERT INTO') and 'WHERE rowid >=' in s]) == 3
+  assert len([s for s in statements if s.startswith('PRAGMA wal_checkpoint')]) == 3
+
+def test_batched_backfill_alter_path():
+  db = sqlite3.connect(':memory:')
+  db.execute('create table tbl (a int, b int)')
+  db.executemany('insert into tbl values (?,?)', [(i, i) for i in range(5)])
+  statements = []
+  db.set_trace_callback(statements.append)
+  for change in diff('create table tbl (a int, b int)', 'create table tbl (a text, b int)'):
+    schema_evolve._execute(db, change, batch_size=2)
+  assert db.execute('select a, typeof(a), b from tbl').fetchall() == [(str(i), 'text', i) for i in range(5)]
+  assert len([s for s in statements if s.startswith('UPDATE') and 'WHERE rowid >=' in s]) == 3
+
+def test_clone_sample(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.executescript('''
+      create table a (id integer primary key, name text);
+      create table b (id integer primary key, a_id int references a(id), x int);
+      create table c (k text primary key, v text) without rowid;
+      create index b_x on b(x);
+      create view v as select * from b;
+    ''')
+    db.executemany('insert into a values (?,?)', [(i, str(i)) for i in range(1000)])
+    db.executemany('insert into b values (?,?,?)', [(i, 999-i, i) for i in range(1000)])
+    db.executemany('insert into c values (?,?)', [(str(i), str(i)) for i in range(1000)])
+  db.close()
+
+  schema_only = sqlite3.connect(':memory:')
+  schema_evolve._clone_sample(db_fn, schema_only, 0)
+  assert schema_only.execute('select type, name, sql from sqlite_schema').fetchall() == sqlite3.connect(db_fn).execute('select type, name, sql from sqlite_schema').fetchall()
+  assert schema_only.execute('select count(*) from b').fetchone() == (0,)
+
+  sampled = sqlite3.connect(':memory:')
+  schema_evolve._clone_sample(db_fn, sampled, 5)
+  assert 5 < sampled.execute('select count(*) from b').fetchone()[0] <= 10
+  assert sampled.execute('select id, a_id from b order by id limit 5').fetchall() == [(i, 999-i) for i in range(5)]
+  assert sampled.execute('select count(*) from b where a_id not in (select id from a)').fetchone() == (0,)
+  assert sampled.execute('select count(*) from c').fetchone() == (5,)
+
+def test_sampled_dry_run(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text)')
+    db.executemany('insert into tbl values (?)', [(str(i),) for i in range(100)] + [(None,)])
+  db.close()
+  schema_evolve.schema_evolve(db_fn, 'create table tbl (a int)', assume_yes=True, quiet=True, no_cache=True, sample=3)
+  # schema only: the empty table happily takes the NOT NULL column (that the pre-flight check refuses)
+  schema_evolve.schema_evolve(db_fn, 'create table tbl (a int not null)', assume_yes=True, quiet=True, no_cache=True, sample=0, force=True)
+  with pytest.raises(sqlite3.OperationalError, match='NOT NULL'):
+    schema_evolve.schema_evolve(db_fn, 'create table tbl (a int not null)', assume_yes=True, quiet=True, no_cache=True, sample=1, force=True)
+
+def test_in_memory_dry_run(tmp_path, monkeypatch):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text)')
+    db.execute("insert into tbl values ('x')")
+  db.close()
+  copies = []
+  copyfile = shutil.copyfile
+  monkeypatch.setattr(shutil, 'copyfile', lambda *args: copies.append(args) or copyfile(*args))
+  with pytest.raises(sqlite3.OperationalError, match='NOT NULL'):
+    schema_evolve.schema_evolve(db_fn, 'create table tbl (a text, b text not null)', assume_yes=True, quiet=True, no_cache=True)
+  assert copies == []
+  with pytest.raises(sqlite3.OperationalError, match='NOT NULL'):
+    schema_evolve.schema_evolve(db_fn, 'create table tbl (a text, b text not null)', assume_yes=True, quiet=True, no_cache=True, memory_limit=0)
+  assert len(copies) == 1
+
+def test_apply_single_transaction(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.executescript('''
+      create table a (id int primary key);
+      create table b (id int primary key, a_id int);
+      insert into a values (1);
+      insert into b values (1, 1);
+    ''')
+  db.close()
+  target = '''
+    create table a (id int primary key);
+    create table b (id int primary key, a_id int references a(id));
+    create table c (x text);
+  '''
+  db = sqlite3.connect(db_fn)
+  statements = []
+  db.set_trace_callback(statements.append)
+  schema_evolve._apply(db, diff(db_fn, target, cache=False))
+  assert statements.count('BEGIN IMMEDIATE') == 1
+  assert statements.count('COMMIT') == 1
+  assert statements.index('PRAGMA foreign_keys=off') < statements.index('BEGIN IMMEDIATE')
+  assert statements[-1] == 'PRAGMA foreign_keys=on'
+  assert [s for s in statements if s.startswith('SAVEPOINT')] == ['SAVEPOINT step_0', 'SAVEPOINT step_1']
+  assert db.execute('PRAGMA foreign_keys').fetchone() == (1,)
+  assert diff(db_fn, target, cache=False) == []
+
+def test_apply_rolls_back_on_error(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.executescript('''
+      create table x (a text);
+      insert into x values (null);
+    ''')
+  db.close()
+  with pytest.raises(sqlite3.OperationalError, match='NOT NULL'):
+    diff(db_fn, 'create table x (a text not null); create table y (b text);', apply=True)
+  db = sqlite3.connect(db_fn)
+  assert db.execute('select name, sql from sqlite_schema').fetchall() == [('x', 'CREATE TABLE x (a text)')]
+  assert db.execute('select * from x').fetchall() == [(None,)]
+
+def test_unknown_file_type(tmp_path):
+  fn = tmp_path / 'junk.bin'
+  fn.write_bytes(b'\x89PNG\r\n\x1a\n\xff\xfe')
+  with pytest.raises(RuntimeError, match='unknown file type'):
+    diff(str(fn), 'create table tbl (a text)')
+
+def test_iter_statements():
+  sql = '''
+    create table a (x text default ';'); -- a comment; with a semicolon
+    create table b (y text); create trigger t after insert on a begin
+      insert into b values (';');
+      delete from b;
+    end;
+    /* trailing; */ create view v as select * from a
+  '''
+  expected = [
+    '''
+    create table a (x text default ';');''',
+    ''' -- a comment; with a semicolon
+    create table b (y text);''',
+    ''' create trigger t after insert on a begin
+      insert into b values (';');
+      delete from b;
+    end;''',
+    '''
+    /* trailing; */ create view v as select * from a
+  ''',
+  ]
+  for chunk_size in (1, 7, 1<<16):
+    assert list(schema_evolve._iter_statements(io.StringIO(sql), chunk_size=chunk_size)) == expected
+
+def test_ddl_only_load():
+  dump = '''
+    PRAGMA foreign_keys=OFF;
+    BEGIN TRANSACTION;
+    CREATE TABLE tbl (a text);
+    INSERT INTO tbl VALUES('x; create table nope (a text);');
+    /* index */ create index tbl_a on tbl(a);
+    COMMIT;
+  '''
+  db = schema_evolve._open(dump, ddl_only=True)
+  assert [row[0] for row in db.execute('select name from sqlite_schema')] == ['tbl', 'tbl_a']
+  assert db.execute('select count(*) from tbl').fetchone() == (0,)
+  assert schema_evolve._open(dump).execute('select count(*) from tbl').fetchone() == (1,)
+
+def test_fleet_evolve(tmp_path, monkeypatch):
+  for i in range(4):
+    with sqlite3.connect(str(tmp_path / f'shard{i}.db')) as db:
+      db.execute('create table tbl (a text)' if i else 'create table tbl (a text unique, b int)')
+      db.executemany('insert into tbl (a) values (?)', [('x',)] * (2 if i==2 else 1))
+    db.close()
+  target = 'create table tbl (a text unique, b int)'
+  results = schema_evolve.fleet_evolve(target, str(tmp_path / 'shard*.db'), workers=1, quiet=True)
+  assert [(os.path.basename(r.db), r.status) for r in results] == [('shard0.db', 'unchanged'), ('shard1.db', 'dry_run'), ('shard2.db', 'failed'), ('shard3.db', 'dry_run')]
+  assert 'UNIQUE' in results[2].error
+  metrics_fn = str(tmp_path / 'metrics.jsonl')
+  results = schema_evolve.fleet_evolve(target, str(tmp_path / 'shard*.db'), workers=2, quiet=True, apply=True, metrics=metrics_fn)
+  assert [r.status for r in results] == ['unchanged', 'applied', 'failed', 'applied']
+  with open(metrics_fn) as f:
+    metrics = [json.loads(line) for line in f]
+  # every worker's statements, tagged with their database
+  assert {(os.path.basename(m['db']), m['stage']) for m in metrics} == {(f'shard{i}.db', stage) for i in (1, 2, 3) for stage in ('dry_run', 'apply')} - {('shard2.db', 'apply')}
+  assert [r.status for r in schema_evolve.fleet_evolve(target, str(tmp_path / 'shard*.db'), workers=2, quiet=True)] == ['unchanged', 'unchanged', 'failed', 'unchanged']
+
+def _report_memory_limit(fn, schema_hash, opts):
+  return schema_evolve.FleetResult(fn, 'planned', None, str(opts['memory_limit']), 0., schema_hash)
+
+def test_fleet_memory_limit(tmp_path, monkeypatch):
+  for i in range(3):
+    sqlite3.connect(str(tmp_path / f'shard{i}.db')).execute('create table tbl (a text)')
+  monkeypatch.setattr(schema_evolve, '_fleet_evolve_db', _report_memory_limit)
+  # the default in-memory dry run limit is shared by the workers, an explicit one is per database
+  limits = lambda **kwargs: {int(r.error) for r in schema_evolve.fleet_evolve('create table tbl (a int)', str(tmp_path / 'shard*.db'), quiet=True, **kwargs)}
+  assert limits(workers=2) == {schema_evolve.MEMORY_DRY_RUN_LIMIT // 2}
+  assert limits(workers=8) == {schema_evolve.MEMORY_DRY_RUN_LIMIT // 3}
+  assert limits(workers=2, memory_limit=1000) == {1000}
+
+def test_fleet_plans_once_per_schema(tmp_path, monkeypatch):
+  for i in range(5):
+    with sqlite3.connect(str(tmp_path / f'shard{i}.db')) as db:
+      # rootpages differ across shards, the schema hash shouldn't care
+      db.executescript('create table other (x int); create table tbl (a text);' if i%2 else 'create table tbl (a text); create table other (x int);')
+      if i == 4:
+        db.execute('create index idx on tbl(a)')
+    db.close()
+  _diff = schema_evolve._diff
+  plans = []
+  monkeypatch.setattr(schema_evolve, '_diff', lambda *args, **kwargs: plans.append(args) or _diff(*args, **kwargs))
+  results = schema_evolve.fleet_evolve('create table tbl (a text, b int); create table other (x int);', str(tmp_path / 'shard*.db'), workers=1, quiet=True, no_cache=True)
+  assert len(plans) == 2
+  assert len({r.schema_hash for r in results}) == 2
+  assert [r.status for r in results] == ['dry_run'] * 5
+  assert [r.changes for r in results] == [['ALTER TABLE "tbl" ADD COLUMN b int']] * 4 + [['DROP INDEX "idx"', 'ALTER TABLE "tbl" ADD COLUMN b int']]
+  plans.clear()
+  schema_evolve.fleet_evolve('create table tbl (a text, b int); create table other (x int);', str(tmp_path / 'shard*.db'), workers=1, quiet=True, no_cache=True, no_group=True)
+  assert len(plans) == 5
+
+def test_fingerprint(tmp_path):
+  sql = '''
+    create table a (id int primary key);
+    create table b ( -- AKA[old_b]
+      id int primary key,
+      a_id int references a(id),
+      name text not null default '' unique
+    );
+    create view v as select * from b;
+  '''
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.executescript(sql)
+  assert schema_evolve.fingerprint(db_fn) == schema_evolve.fingerprint(sql)
+  assert schema_evolve.fingerprint(db) == schema_evolve.fingerprint(sql)
+  db.close()
+  reformatted = '''
+    CREATE TABLE b (id int primary key, a_id int references a(id), name text not null default '', unique (name));
+    CREATE TABLE a (id int primary key);
+    create view v as
+      select * from b;
+  '''
+  assert schema_evolve.fingerprint(reformatted) == schema_evolve.fingerprint(sql)
+  assert diff(sql, reformatted) == []
+  assert schema_evolve.fingerprint(sql.replace('not null', '')) != schema_evolve.fingerprint(sql)
+  assert schema_evolve.fingerprint(sql.replace('references a(id)', '')) != schema_evolve.fingerprint(sql)
+
+def test_async(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text)')
+    db.execute("insert into tbl values ('1')")
+  db.close()
+  target = 'create table tbl (a int); create table other (b text);'
+
+  async def evolve(**kwargs):
+    return [p async for p in schema_evolve.schema_evolve_async(db_fn, target, cache=False, **kwargs)]
+  async def cancel_after_first_applied_statement():
+    async for progress in schema_evolve.schema_evolve_async(db_fn, target, cache=False, dry_run=False, apply=True):
+      if progress.stage == 'apply':
+        raise asyncio.CancelledError
+  async def concurrently():
+    return await asyncio.gather(*[schema_evolve.diff_async(db_fn, target, cache=False) for _ in range(4)])
+
+  changes = diff(db_fn, target, cache=False)
+  assert len(asyncio.run(concurrently())) == 4
+  assert all(changes == c for c in asyncio.run(concurrently()))
+  progress = asyncio.run(evolve())
+  assert [p.statement for p in progress if p.stage == 'plan'] == changes
+  assert [p.statement for p in progress if p.stage == 'dry_run'] == changes
+  with pytest.raises(asyncio.CancelledError):
+    asyncio.run(cancel_after_first_applied_statement())
+  # rolled back, the table wasn't touched
+  assert diff(db_fn, target, cache=False) == changes
+  metrics = []
+  progress = asyncio.run(evolve(apply=True, metrics=metrics.append))
+  assert [p.stage for p in progress] == ['plan'] * len(changes) + ['dry_run'] * len(changes) + ['apply'] * len(changes)
+  assert [(m.stage, m.statement) for m in metrics] == [('dry_run', c) for c in changes+['COMMIT']] + [('apply', c) for c in changes+['COMMIT']]
+  assert diff(db_fn, target, cache=False) == []
+  with sqlite3.connect(db_fn) as db:
+    db.execute('insert into tbl values (1)')
+  db.close()
+  target = 'create table tbl (a int unique); create table other (b text);'
+  with pytest.raises(sqlite3.IntegrityError):
+    asyncio.run(evolve())
+
+def test_online_rebuild(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (id integer primary key, a text, b text)')
+    db.execute('create index tbl_a on tbl(a)')
+    db.execute('create table child (tbl_id int references tbl(id))')
+    db.execute('create table log (id int)')
+    db.execute('create trigger tbl_log after delete on tbl begin insert into log values (OLD.id); end')
+    db.executemany('insert into tbl values (?, ?, ?)', [(i, str(i), 'x') for i in range(1, 11)])
+  db.close()
+  target = '''
+    create table tbl (id integer primary key, a int, c text default 'c');
+    create index tbl_a on tbl(a);
+    create table child (tbl_id int references tbl(id));
+    create table log (id int);
+  '''
+  changes = diff(db_fn, target, cache=False, online=True)
+  assert [c.split(' ON ')[0] for c in changes if c.startswith('CREATE TRIGGER "__tmp_trg_')] == [
+    'CREATE TRIGGER "__tmp_trg_c619e1_insert__" AFTER INSERT',
+    'CREATE TRIGGER "__tmp_trg_c619e1_update__" AFTER UPDATE',
+    'CREATE TRIGGER "__tmp_trg_c619e1_delete__" AFTER DELETE',
+  ]
+  # indexes are built on the shadow table before the copy, so the swap only renames
+  assert changes[2] == 'CREATE INDEX "tbl_a__online" on "__tmp_tbl_c619e1__"(a)'
+  assert changes[changes.index('BEGIN IMMEDIATE'):] == [
+    'BEGIN IMMEDIATE',
+    'DROP TRIGGER "__tmp_trg_c619e1_insert__"',
+    'DROP TRIGGER "__tmp_trg_c619e1_update__"',
+    'DROP TRIGGER "__tmp_trg_c619e1_delete__"',
+    'DROP TRIGGER "tbl_log"',
+    'PRAGMA legacy_alter_table=on',
+    'ALTER TABLE "tbl" RENAME TO "__old_tbl_c619e1__"',
+    'ALTER TABLE "__tmp_tbl_c619e1__" RENAME TO "tbl"',
+    'PRAGMA legacy_alter_table=off',
+    'CREATE TRIGGER tbl_log after delete on tbl begin insert into log values (OLD.id); end',
+    'COMMIT',
+    'DELETE FROM "__old_tbl_c619e1__"',
+    'DROP TABLE "__old_tbl_c619e1__"',
+    'PRAGMA foreign_keys=on',
+  ]
+  # a single change still goes through the online rebuild
+  assert 'BEGIN IMMEDIATE' in diff(db_fn, target.replace("c text default 'c'", 'b text'), cache=False, online=True)
+  # WITHOUT ROWID tables can't be mirrored by rowid, they fall back to the offline rebuild
+  changes_without_rowid = diff(db_fn, target.replace("default 'c')", "default 'c') without rowid"), cache=False, online=True)
+  assert 'INSERT INTO "__tmp_tbl_c619e1__" ("id","a") SELECT CAST("id" as INTEGER), CAST("a" as INT) FROM "tbl"' in changes_without_rowid
+  assert 'BEGIN IMMEDIATE' not in changes_without_rowid
+
+  # without batches the swap's transaction folds into the plan's single one
+  shutil.copyfile(db_fn, str(tmp_path / 'copy.db'))
+  db = sqlite3.connect(str(tmp_path / 'copy.db'))
+  schema_evolve._apply(db, changes)
+  assert db.execute('select a from tbl where id = 1').fetchone() == (1,)
+  db.close()
+
+  class Connection(sqlite3.Connection):
+    writes = [
+      'insert into tbl values (100, \'100\', \'x\')',
+      'update tbl set a = \'41\' where id = 1', # already copied
+      'update tbl set a = \'99\' where id = 9', # not copied yet
+      'delete from tbl where id in (2, 8)',
+      'insert into tbl values (0, \'0\', \'x\')',
+    ]
+    def execute(self, sql, *args):
+      cursor = super().execute(sql, *args)
+      if sql == 'COMMIT' and self.writes and super().execute('select count(*) from "__tmp_tbl_c619e1__"').fetchone()[0]:
+        # another writer gets in between two batches of the copy
+        with sqlite3.connect(db_fn) as other:
+          for sql in self.writes:
+            other.execute(sql)
+        other.close()
+        self.writes = []
+      return cursor
+  db = sqlite3.connect(db_fn, factory=Connection)
+  schema_evolve._apply(db, changes, batch_size=3)
+  assert Connection.writes and not db.writes
+  assert db.execute('select * from tbl order by id').fetchall() == [(0, 0, 'c'), (1, 41, 'c'), (3, 3, 'c'), (4, 4, 'c'), (5, 5, 'c'), (6, 6, 'c'), (7, 7, 'c'), (9, 99, 'c'), (10, 10, 'c'), (100, 100, 'c')]
+  assert db.execute("select type, name from sqlite_schema order by name").fetchall() == [('table', 'child'), ('table', 'log'), ('table', 'tbl'), ('index', 'tbl_a__online'), ('trigger', 'tbl_log')]
+  # only the concurrent delete got logged, emptying the old table didn't fire its triggers
+  assert db.execute('select id from log order by id').fetchall() == [(2,), (8,)]
+  assert db.execute("select sql from sqlite_schema where name = 'child'").fetchone() == ('CREATE TABLE child (tbl_id int references tbl(id))',)
+  db.close()
+  assert diff(db_fn, target, cache=False) == []
+  # the next online rebuild takes the index's name back
+  changes = diff(db_fn, target.replace("default 'c'", "default 'd'"), cache=False, online=True)
+  assert changes[2] == 'CREATE INDEX "tbl_a" on "__tmp_tbl_c619e1__"(a)'
+
+def test_batched_apply_holds_off_writers(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (id integer primary key, a text)')
+    db.executemany('insert into tbl values (?, ?)', [(i, str(i)) for i in range(1, 11)])
+  db.close()
+  target = 'create table tbl (id integer primary key, a int)'
+  writes = ["insert into tbl values (100, '5')", "update tbl set a = '41' where id = 1"]
+  class Connection(sqlite3.Connection):
+    def execute(self, sql, *args):
+      cursor = super().execute(sql, *args)
+      if sql == 'COMMIT':
+        # another writer tries to get in after every statement and batch of the offline plans
+        other = sqlite3.connect(self.fn, timeout=0)
+        with pytest.raises(sqlite3.OperationalError, match='locked'):
+          other.execute(writes[0])
+        other.close()
+        self.blocked += 1
+      return cursor
+  for rebuild in (False, True):
+    fn = str(tmp_path / f'rebuild_{rebuild}.db')
+    shutil.copyfile(db_fn, fn)
+    changes = diff(fn, target, cache=False, rebuild=rebuild)
+    assert any(c.startswith('UPDATE' if not rebuild else 'INSERT') for c in changes)
+    db = sqlite3.connect(fn, factory=Connection)
+    db.fn, db.blocked = fn, 0
+    schema_evolve._apply(db, changes, batch_size=3)
+    assert db.blocked > 4
+    db.close()
+    # the writer gets its turn once the plan is through, so no write is lost to a stale copy
+    with sqlite3.connect(fn) as other:
+      for sql in writes:
+        other.execute(sql)
+      assert other.execute('select id, a from tbl where id in (1, 100)').fetchall() == [(1, 41), (100, 5)]
+    other.close()
+    assert diff(fn, target, cache=False) == []
+
+def test_apply_busy_retry(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text)')
+  db.close()
+  other = sqlite3.connect(db_fn, isolation_level=None, check_same_thread=False)
+  other.execute('BEGIN IMMEDIATE')
+  timer = threading.Timer(.2, other.rollback)
+  timer.start()
+  db = sqlite3.connect(db_fn, timeout=.01)
+  stats = schema_evolve._apply(db, diff(db_fn, 'create table tbl (a text, b int)', cache=False))
+  timer.join()
+  assert stats.retries > 0 and stats.waited >= .15 and stats.transactions == 1
+  assert diff(db_fn, 'create table tbl (a text, b int)', cache=False) == []
+  other.execute('BEGIN IMMEDIATE')
+  with pytest.raises(sqlite3.OperationalError, match='locked'):
+    schema_evolve._apply(db, diff(db_fn, 'create table tbl (a text, b int, c int)', cache=False), retries=1)
+  other.rollback()
+
+def test_apply_lock_budget(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a int)')
+    db.executemany('insert into tbl values (?)', [(i,) for i in range(1000)])
+  db.close()
+  db = sqlite3.connect(db_fn)
+  statements = []
+  db.set_trace_callback(statements.append)
+  # well within budget, the batches grow: 10, 20, 40, ... instead of 100 batches of 10
+  stats = schema_evolve._apply(db, diff(db_fn, 'create table tbl (a text)', cache=False), batch_size=10, lock_budget=1000)
+  batches = [s for s in statements if s.startswith('UPDATE') and 'WHERE rowid >=' in s]
+  assert len(batches) == 7
+  assert stats.transactions == len(batches) + 3 and stats.over_budget == 0
+  assert stats.max_held <= stats.held
+  db.execute('delete from tbl where rowid > 100')
+  db.commit()
+  statements.clear()
+  # way over budget, the batches shrink to a row
+  stats = schema_evolve._apply(db, diff(db_fn, 'create table tbl (a int)', cache=False), batch_size=4, lock_budget=1e-6)
+  batches = [s for s in statements if s.startswith('UPDATE') and 'WHERE rowid >=' in s]
+  assert len(batches) == 2 + 94 and stats.over_budget == stats.transactions # 4 rows, 2, then one at a time
+  assert db.execute('select count(*), typeof(a) from tbl').fetchone() == (100, 'integer')
+
+def test_metrics(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('pragma journal_mode=wal')
+    db.execute('create table tbl (a text, b text)')
+    db.executemany('insert into tbl values (?, ?)', [(str(i), 'x'*100) for i in range(1000)])
+  db.close()
+  target = 'create table tbl (a int, b text)'
+  changes = diff(db_fn, target, cache=False)
+  metrics_fn = str(tmp_path / 'metrics.jsonl')
+  schema_evolve.schema_evolve(db_fn, target, apply=True, assume_yes=True, quiet=True, no_cache=True, metrics=metrics_fn)
+  with open(metrics_fn) as f:
+    metrics = [json.loads(line) for line in f]
+  assert [(m['stage'], m['statement']) for m in metrics] == [('dry_run', c) for c in changes+['COMMIT']] + [('apply', c) for c in changes+['COMMIT']]
+  update = [m for m in metrics if m['stage'] == 'apply' and m['statement'].startswith('UPDATE')][0]
+  assert update['rows_changed'] == 1000 and update['seconds'] > 0 and update['error'] is None
+  # the single transaction's pages hit the WAL on COMMIT
+  commit = metrics[-1]
+  assert commit['wal_growth'] > 100*1000 and commit['journal_growth'] == 0 and commit['db_growth'] == 0
+  # in RAM there are no files to measure
+  assert all(m['wal_growth'] == 0 == m['journal_growth'] for m in metrics if m['stage'] == 'dry_run')
+
+  metrics = []
+  with sqlite3.connect(db_fn) as db:
+    db.execute('insert into tbl values (null, null)')
+  db.close()
+  db = sqlite3.connect(db_fn)
+  with pytest.raises(sqlite3.IntegrityError):
+    schema_evolve._apply(db, diff(db_fn, 'create table tbl (a int not null default 0, b text not null)', cache=False), batch_size=100, metrics=metrics.append)
+  assert metrics[-1].error.startswith('IntegrityError: NOT NULL') and metrics[-1].lock_wait >= 0
+  assert all(m.stage == 'apply' and m.error is None for m in metrics[:-1])
+
+def test_estimate(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text, b text)')
+    db.execute('create table other (c text)')
+    db.executemany('insert into tbl values (?, ?)', [(str(i), 'x'*100) for i in range(1000)])
+  costs = schema_evolve.estimate(db, diff(db_fn, 'create table tbl (a int, b text, d text unique); create table other (c text, e text)', cache=False))
+  assert [(c.cost_class, c.tbl_name) for c in costs if c.cost_class != 'metadata'] == [('rewrite', 'tbl'), ('rewrite', 'tbl'), ('index', 'tbl')]
+  update = [c for c in costs if c.statement.startswith('UPDATE')][0]
+  assert update.rows == 1000 and update.pages > 25 and update.seconds > 0 and update.disk == update.pages*4096
+  # without dbstat, the database's pages are split between the tables by row count
+  page_count = db.execute('pragma page_count').fetchone()[0]
+  assert [c.pages for c in costs if c.cost_class == 'rewrite'] == [page_count, page_count]
+  [exact] = schema_evolve.estimate(db, [update.statement], dbstat=True)
+  assert 25 < exact.pages < page_count
+  assert [c for c in costs if c.tbl_name == 'other'] == [('ALTER TABLE "other" ADD COLUMN e text', 'metadata', 'other', 0, 0, 0, 0)]
+  # a rebuild copies the table and drops the old one, ANALYZE's row counts win over max(rowid)
+  db.execute('delete from tbl where rowid > 500')
+  db.execute('analyze')
+  costs = schema_evolve.estimate(db, diff(db_fn, 'create table tbl (a int, b int, c int); create table other (c text, e text)', rebuild=True, cache=False))
+  assert [(c.cost_class, c.tbl_name, c.rows) for c in costs if c.cost_class != 'metadata'] == [('copy', 'tbl', 500), ('drop', 'tbl', 500)]
+  db.close()
+
+  target = 'create table tbl (a int, b text)'
+  with pytest.raises(RuntimeError, match='over max_seconds=0'):
+    schema_evolve.schema_evolve(db_fn, target, apply=True, assume_yes=True, quiet=True, no_cache=True, max_seconds=0)
+  assert diff(db_fn, target, cache=False)
+  schema_evolve.schema_evolve(db_fn, target, apply=True, assume_yes=True, quiet=True, no_cache=True, max_seconds=0, force=True)
+  assert not diff(db_fn, target, cache=False)
+
+def test_preflight(tmp_path):
+  db_fn = str(tmp_path / 'existing.db')
+  with sqlite3.connect(db_fn) as db:
+    db.execute('create table tbl (a text, b real, c text, d int)')
+    db.executemany('insert into tbl values (?, ?, ?, ?)', [('1', 1.5, 'x', 1), ('abc', 2.0, None, 2), (None, None, None, None)])
+  db.close()
+  db = sqlite3.connect(db_fn)
+  queries = []
+  db.set_trace_callback(queries.append)
+  tbls2 = schema_evolve._get_tables(schema_evolve._open("create table tbl (aa int -- AKA[a]\n, b int, c text not null default 'y', d int)"))
+  assert schema_evolve.preflight(db, tbls2) == [
+    ('tbl', 'aa', 'TEXT', 'INT', 3, 1, 0, 0),
+    ('tbl', 'b', 'REAL', 'INT', 3, 1, 0, 0),
+    ('tbl', 'c', 'TEXT', 'TEXT', 3, 0, 2, 0),
+  ]
+  # every changed column of a table in one scan
+  assert len([q for q in queries if q.startswith('SELECT count(*)')]) == 1
+  db.close()
+
+  target = 'create table tbl (a int not null, b real, c text, d int)'
+  with pytest.raises(RuntimeError, match='1 rows of tbl.a would be NULL'):
+    schema_evolve.schema_evolve(db_fn, target, apply=True, assume_yes=True, quiet=True, no_cache=True)
+  assert diff(db_fn, target, cache=False)
+  # skipped, it's the dry run that fails
+  with pytest.raises(sqlite3.OperationalError, match='NOT NULL'):
+    schema_evolve.schema_evolve(db_fn, target, apply=True, assume_yes=True, quiet=True, no_cache=True, no_preflight=True)
+
+def test_diff_indexes():
+  src = '''
+    create table tbl (id int primary key, a int, b text, c text);
+    create index tbl_a on tbl(a);
+    create index tbl_c on tbl(c desc) where c is not null;
+    create index tbl_ac on tbl(a, c);
+  '''
+  # matched by definition, however it's spelled, through column renames
+  target = '''
+    create table tbl (id int primary key, a int, b text, cc text -- AKA[c]
+    );
+    create index tbl_a on tbl(a);
+    create index "tbl_cc" on "TBL" ( "CC" DESC ) WHERE cc IS NOT NULL;
+    create index tbl_b on tbl(b);
+    create table other (x int);
+    create index other_x on other(x);
+  '''
+  assert diff(src, target, apply=True) == [
+    'CREATE TABLE other (x int)',
+    'CREATE INDEX other_x on other(x)',
+    'DROP INDEX "tbl_ac"',
+    'ALTER TABLE "tbl" RENAME COLUMN "c" TO "cc"',
+    'CREATE INDEX tbl_b on tbl(b)',
+  ]
+  tbls = _get_tables(schema_evolve._open(src))
+  assert tbls['tbl'].indexes['tbl_ac'] == ('tbl_ac', 'tbl', ('a', 'c'), False, 'CREATE INDEX tbl_ac on tbl(a, c)')
+  assert schema_evolve.fingerprint(src) != schema_evolve.fingerprint(src.replace('create index tbl_a on tbl(a);', ''))
+  assert schema_evolve.fingerprint(src) == schema_evolve.fingerprint(src.replace('create index tbl_a on tbl(a);', 'create index i on "tbl" ("A");'))
+
+def test_deferred_indexes():
+  src = '''
+    create table old (id int primary key, a int, b int, c int);
+    create unique index old_a on old(a);
+    create index old_b on old(b);
+    create index old_c on old(c);
+    insert into old values (1, 2, 3, 4);
+  '''
+  target = '''
+    create table tbl ( -- AKA[old]
+      id int primary key, a text, b text, c int);
+    create unique index tbl_a on tbl(a);
+    create index old_b on tbl(b);
+    create index old_c on tbl(c);
+  '''
+  # indexes on rewritten columns are dropped before the backfill and built on the final data
+  changes = diff(src, target, rebuild=False)
+  assert [c for c in changes if 'INDEX' in c] == [
+    'DROP INDEX "old_a"',
+    'DROP INDEX "old_b"',
+    'CREATE UNIQUE INDEX old_a on "tbl"(a)',
+    'CREATE INDEX old_b on "tbl"(b)',
+  ]
+  assert changes.index('CREATE UNIQUE INDEX old_a on "tbl"(a)') > max(i for i, c in enumerate(changes) if c.startswith(('UPDATE', 'ALTER TABLE "tbl" DROP COLUMN')))
+  for rebuild in (False, True):
+    db = schema_evolve._open(src)
+    schema_evolve._apply(db, diff(src, target, rebuild=rebuild))
+    assert sorted(_get_tables(db)['tbl'].indexes) == ['old_a', 'old_b', 'old_c']
+    assert db.execute('select a, b, c from tbl').fetchall() == [('2', '3', 4)]
+    assert schema_evolve.fingerprint(db) == schema_evolve.fingerprint(target)
+
+def test_optimize(tmp_path, monkeypatch):
+  src = '''
+    create table a (id int primary key);
+    create table b (id int primary key, x int references a(id));
+    insert into a values (1);
+    insert into b values (1, '1');
+  '''
+  target = 'create table a (id int primary key); create table b (id int primary key, x text);'
+  # the column def and the FK branch both move x aside
+  raw = diff(src, target, rebuild=False, optimize=False)
+  assert raw.count('ALTER TABLE "b" RENAME COLUMN "x" TO __tmp_col_43f885__') == 2
+  changes = diff(src, target, rebuild=False)
+  assert changes == [
+    'ALTER TABLE "b" RENAME COLUMN "x" TO __tmp_col_43f885__',
+    'ALTER TABLE "b" ADD COLUMN x text',
+    'UPDATE "b" SET "x" = CAST(__tmp_col_43f885__ as TEXT)',
+    'ALTER TABLE "b" DROP COLUMN __tmp_col_43f885__',
+  ]
+  assert (changes.statements_saved, changes.rewrites_saved, changes.restructured) == (3, 1, {'b'})
+  db = schema_evolve._open(src)
+  schema_evolve._apply(db, changes)
+  assert db.execute('select x, typeof(x) from b').fetchall() == [('1', 'text')]
+  assert schema_evolve.fingerprint(db) == schema_evolve.fingerprint(target)
+
+  # consecutive rebuilds don't turn FKs back on in between
+  changes = diff('create table t1 (a int, b int, c int); create table t2 (a int, b int, c int);', 'create table t1 (a text, b text, c text); create table t2 (a text, b text, c text);')
+  assert [c for c in changes if c.startswith('PRAGMA foreign_keys')] == ['PRAGMA foreign_keys=off', 'PRAGMA foreign_keys=on']
+  assert (changes.statements_saved, changes.rewrites_saved, changes.restructured) == (2, 0, set())
+
+  # optimizations that change the resulting schema are caught by re-diffing
+  _optimize = schema_evolve._optimize
+  monkeypatch.setattr(schema_evolve, '_optimize', lambda cmds: schema_evolve.Plan(_optimize(cmds)[:-1], restructured={'b'}))
+  with pytest.raises(RuntimeError, match='optimized plan leaves a different schema'):
+    diff(src, target, rebuild=False)